@@ -1,8 +1,26 @@
 import json
-from pprint import pprint
 import argparse
-from math import sin, cos
+import copy
+import hashlib
+import importlib
+from collections import OrderedDict, defaultdict, deque
+from itertools import islice
+from math import sin, cos, ceil, pi
+import mmap
+import os
+import pickle
+import re
+import shutil
+import struct
 import sys
+import tempfile
+import threading
+from timeit import default_timer
+import tracemalloc
+import warnings
+
+# Reported as part of the startup time by --profile.
+STARTED = default_timer()
 
 # An attempt at Python2/Python3 compat.
 try:
@@ -10,227 +28,2779 @@ try:
 except ImportError:
     from io import BytesIO as CharIO
 
-from PyPDF2 import PdfFileWriter, PdfFileReader
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfgen import canvas
 
+class LazyImport(object):
+    """
+    A module, or a name from a module, imported when it is first used so
+    that a command only pays for the libraries it needs. Once imported it
+    replaces itself in this module, so later uses cost nothing.
+    """
+
+    def __init__(self, module, name=None):
+        self._module = module
+        self._name = name
+        self._alias = name or module.rsplit('.', 1)[-1]
+        self._target = None
+
+    def _resolve(self):
+        """
+        Import and return the module or name.
+        """
+        if self._target is None:
+            target = importlib.import_module(self._module)
+            if self._name:
+                target = getattr(target, self._name)
+            self._target = target
+            # Unless it was patched in the meantime.
+            if globals().get(self._alias) is self:
+                globals()[self._alias] = target
+        return self._target
+
+    def __getattr__(self, attr):
+        if attr in ('_module', '_name', '_alias', '_target'):
+            raise AttributeError(attr)
+        return getattr(self._resolve(), attr)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def __instancecheck__(self, obj):
+        return isinstance(obj, self._resolve())
+
+    def __subclasscheck__(self, cls):
+        return issubclass(cls, self._resolve())
+
+    def __repr__(self):
+        return '<LazyImport {}>'.format(".".join(
+                x for x in (self._module, self._name) if x))
+
+
+asyncio = LazyImport('asyncio')
+cProfile = LazyImport('cProfile')
+multiprocessing = LazyImport('multiprocessing')
+pstats = LazyImport('pstats')
+subprocess = LazyImport('subprocess')
+ProcessPoolExecutor = LazyImport('concurrent.futures', 'ProcessPoolExecutor')
+PdfFileWriter = LazyImport('PyPDF2', 'PdfFileWriter')
+PdfFileReader = LazyImport('PyPDF2', 'PdfFileReader')
+FlateDecode = LazyImport('PyPDF2.filters', 'FlateDecode')
+ArrayObject = LazyImport('PyPDF2.generic', 'ArrayObject')
+BooleanObject = LazyImport('PyPDF2.generic', 'BooleanObject')
+DecodedStreamObject = LazyImport('PyPDF2.generic', 'DecodedStreamObject')
+DictionaryObject = LazyImport('PyPDF2.generic', 'DictionaryObject')
+EncodedStreamObject = LazyImport('PyPDF2.generic', 'EncodedStreamObject')
+FloatObject = LazyImport('PyPDF2.generic', 'FloatObject')
+IndirectObject = LazyImport('PyPDF2.generic', 'IndirectObject')
+NameObject = LazyImport('PyPDF2.generic', 'NameObject')
+NumberObject = LazyImport('PyPDF2.generic', 'NumberObject')
+StreamObject = LazyImport('PyPDF2.generic', 'StreamObject')
+TextStringObject = LazyImport('PyPDF2.generic', 'TextStringObject')
+escapePDF = LazyImport('reportlab.lib.rl_accel', 'escapePDF')
+fp_str = LazyImport('reportlab.lib.rl_accel', 'fp_str')
+pdfdoc = LazyImport('reportlab.pdfbase.pdfdoc')
+pdfmetrics = LazyImport('reportlab.pdfbase.pdfmetrics')
+canvas = LazyImport('reportlab.pdfgen.canvas')
+PDFPathObject = LazyImport('reportlab.pdfgen.pathobject', 'PDFPathObject')
+
+
+LEFT = 'left'
+RIGHT = 'right'
+CENTER = 'center'
+PREVIEW_COLOR = (0x20, 0xF0, 0x90,)
+PI = 3.14159
+OUTPUT_PATTERN = '{name}.pdf'
+RENDER_PATH = '/render/'
+BASE_FORM_CACHE_BYTES = 256 * 1024 * 1024
+IMAGE_CACHE_BYTES = 64 * 1024 * 1024
+RESULT_CACHE_BYTES = 1024 * 1024 * 1024
+# Eviction removes entries until the result cache is this full.
+RESULT_CACHE_LOW_WATER = 0.9
+# Bump when a change to rendering changes the output for the same input.
+RESULT_CACHE_VERSION = 1
+COMPILED_FIELDS_MAX = 4096
+IMAGE_DIGESTS_MAX = 4096
+ASYNC_MAX_IN_FLIGHT = 64
+# Chunks of batch jobs queued per worker process.
+BATCH_WINDOW = 2
+# Resource name of the overlay drawn on pages of a combined PDF.
+OVERLAY_NAME = '/FillerOverlay'
+FONT_NAME = '/FillerFont{}'
+# The standard 14 fonts every PDF viewer has.
+STANDARD_FONTS = frozenset(['Courier', 'Courier-Bold', 'Courier-Oblique',
+        'Courier-BoldOblique', 'Helvetica', 'Helvetica-Bold',
+        'Helvetica-Oblique', 'Helvetica-BoldOblique', 'Times-Roman',
+        'Times-Bold', 'Times-Italic', 'Times-BoldItalic', 'Symbol',
+        'ZapfDingbats'])
+WIDGET_NAME = '/FillerWidget{}'
+WIDGET_PADDING = 2
+WIDGET_FONT_SIZE = 12
+WIDGET_DA = '/Helv 0 Tf 0 g'
+# Bump when a change to FormRenderer makes older bundles unusable.
+BUNDLE_VERSION = 1
+BUNDLE_MAGIC = 'filler-bundle'
+# FormRenderer state saved in a bundle. See FormRenderer.bundle().
+BUNDLE_ATTRIBUTES = ('base_form', 'preview', 'extra_data', 'dynamic_extra',
+        'static_plan', 'template', 'layout', 'compiled',)
+# Glyph widths measured ahead when compiling a bundle: printable Latin-1.
+BUNDLE_GLYPHS = [chr(x) for x in range(0x20, 0x100)
+        if not 0x7F <= x < 0xA0]
+JSON_READ_SIZE = 64 * 1024
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+BENCH_ITERATIONS = 20
+BENCH_TOLERANCE = 0.2
+# Synthetic benchmark forms. Fields and images are per page.
+BENCH_SCENARIOS = OrderedDict([
+    ('small', {'pages': 1, 'fields': 10}),
+    ('many-fields', {'pages': 1, 'fields': 200}),
+    ('many-pages', {'pages': 20, 'fields': 10}),
+    ('long-text', {'pages': 1, 'fields': 20, 'text': 400}),
+    ('images', {'pages': 1, 'fields': 2, 'images': 20}),
+    ('rotated', {'pages': 1, 'fields': 50, 'rotation': 45}),
+])
+# Timed stages. A document is all of the others but startup; overlay
+# includes render_field. Startup is a new interpreter importing filler and
+# loading a bundle of the form.
+BENCH_STAGES = ('document', 'startup', 'init', 'render_field', 'overlay',
+        'merge', 'write',)
+BENCH_STARTUP = ("import sys; sys.path.insert(0, sys.argv[1]); import filler; "
+        "filler.FormRenderer(None, None, None, bundle_file=sys.argv[2])")
+BENCH_TEXT = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed "
+        "do eiusmod tempor incididunt ut labore et dolore magna aliqua. ")
+TRUNCATE = 'truncate'
+ELLIPSIS = 'ellipsis'
+SHRINK = 'shrink'
+WRAP = 'wrap'
+FIT_STRATEGIES = (TRUNCATE, ELLIPSIS, SHRINK, WRAP,)
+ELLIPSIS_TEXT = '...'
+MIN_FONT_SIZE = 4
+# Line spacing as a multiple of font size. Same as reportlab's default.
+LEADING = 1.2
+STRING_WIDTH_CACHE_SIZE = 4096
+# Longest text whose width is memoized.
+STRING_WIDTH_CACHE_LENGTH = 128
+PROFILE_LINES = 30
+# Field attributes that are not part of the layout.
+VALUE_KEYS = ('data', 'text', 'comment', 'name', 'static',)
+
+
+class RenderWarning(UserWarning):
+    """
+    Something in the form data could not be rendered.
+    """
+
+
+def copy_page(page):
+    """
+    Shallow copy of a base form page. Merging an overlay onto the copy leaves
+    the parsed base form untouched so it can be reused for the next render.
+    """
+    return copy.copy(page)
+
+
+def copy_direct(obj):
+    """
+    Copy a PDF object along with the dictionaries and arrays it holds
+    directly. Indirect references are kept, so the copy can be changed
+    without changing the parsed base form.
+    """
+    if isinstance(obj, DictionaryObject) and not isinstance(obj, StreamObject):
+        result = DictionaryObject()
+        for key, value in obj.items():
+            result[key] = copy_direct(value)
+        return result
+    if isinstance(obj, ArrayObject):
+        return ArrayObject(copy_direct(x) for x in obj)
+    return obj
+
+
+def map_file(f):
+    """
+    Map an open file read-only. Return None if it cannot be mapped, such as
+    an empty file or a pipe.
+    """
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (TypeError, ValueError, EnvironmentError):
+        return None
+
+
+def pdf_string(text):
+    """
+    Encode text as a PDF literal string for a content stream.
+    """
+    data = text.encode('latin-1', 'replace')
+    for char in (b'\\', b'(', b')'):
+        data = data.replace(char, b'\\' + char)
+    return b'(' + data + b')'
+
+
+def color_operator(components, stroke=False):
+    """
+    Content stream operator setting the color of an /MK color array, or an
+    empty string for a transparent color.
+    """
+    operators = {1: 'g', 3: 'rg', 4: 'k'}
+    operator = operators.get(len(components))
+    if operator is None:
+        return ''
+    if stroke:
+        operator = operator.upper()
+    return ' '.join(['{:.3f}'.format(float(x)) for x in components] +
+            [operator])
+
+
+def index_by_page(entries):
+    """
+    Bucket (compiled field, ...) entries by page. Return a dict of page
+    number to entries in their original order.
+    """
+    pages = {}
+    for entry in entries:
+        pages.setdefault(entry[0].page, []).append(entry)
+    return pages
+
+
+def field_value(field):
+    """
+    Support 'data' and 'text' attributes. Preference for 'data'.
+    """
+    if 'data' in field:
+        return field['data']
+    return field.get('text')
+
+
+def wrap_text(text, max_width, max_lines, fit):
+    """
+    Break text into at most max_lines lines no wider than max_width. Break
+    at the last space that fits, or mid-word if a word is too long. Text
+    that does not fit on the last line is truncated. fit(text, max_width)
+    returns the length of the longest prefix that fits.
+    """
+    lines = []
+    while text and len(lines) < max_lines:
+        end = fit(text, max_width)
+        if end == 0:
+            break
+        if end < len(text) and len(lines) < max_lines - 1:
+            space = text.rfind(' ', 0, end + 1)
+            if space > 0:
+                end = space
+        lines.append(text[:end].rstrip())
+        text = text[end:].lstrip()
+    return lines
+
+
+class FontMetrics(object):
+    """
+    Glyph widths and ascent of one font. Glyph widths are looked up once per
+    character and string widths are memoized in a bounded LRU, so measuring
+    text is a table lookup. Use font_metrics() to get the shared instance.
+    """
+
+    def __init__(self, font_face, max_strings=STRING_WIDTH_CACHE_SIZE):
+        self.font_face = font_face
+        self.ascent = pdfmetrics.getFont(font_face).face.ascent / 1000.0
+        self.glyphs = {}
+        self.strings = OrderedDict()
+        self.max_strings = max_strings
+        self.hits = 0
+        self.misses = 0
+
+    def glyph_width(self, char):
+        """
+        Width of one character at font size 1000.
+        """
+        width = self.glyphs.get(char)
+        if width is None:
+            width = pdfmetrics.stringWidth(char, self.font_face, 1000)
+            self.glyphs[char] = width
+        return width
+
+    def string_width(self, text, size):
+        """
+        Width of text at the given font size. Only texts of up to
+        STRING_WIDTH_CACHE_LENGTH characters are memoized, so the LRU holds
+        at most max_strings short strings rather than whole field values.
+        """
+        if len(text) > STRING_WIDTH_CACHE_LENGTH:
+            self.misses += 1
+            return sum(self.glyph_width(c) for c in text) * size / 1000.0
+        key = (text, size)
+        width = self.strings.pop(key, None)
+        if width is None:
+            self.misses += 1
+            width = sum(self.glyph_width(c) for c in text) * size / 1000.0
+            if len(self.strings) >= self.max_strings:
+                self.strings.popitem(last=False)
+        else:
+            self.hits += 1
+        self.strings[key] = width
+        return width
+
+    def fit_prefix(self, text, max_width, size):
+        """
+        Length of the longest prefix of text no wider than max_width. Sums
+        glyph widths up to the cut point instead of measuring each prefix,
+        without memoizing the text.
+        """
+        limit = max_width * 1000.0 / size
+        total = 0.0
+        for i, char in enumerate(text):
+            total += self.glyph_width(char)
+            if total > limit:
+                return i
+        return len(text)
+
+
+# FontMetrics by font face. See font_metrics().
+_font_metrics = {}
+
+
+def font_metrics(font_face):
+    """
+    Return the shared FontMetrics for a font face.
+    """
+    metrics = _font_metrics.get(font_face)
+    if metrics is None:
+        metrics = _font_metrics[font_face] = FontMetrics(font_face)
+    return metrics
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of values. Zero if there are no values.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = int(ceil(pct / 100.0 * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+
+def iter_json_array(f, read_size=JSON_READ_SIZE):
+    """
+    Yield the elements of a JSON array from file f one at a time. The file
+    is read incrementally, so only the element being parsed and at most one
+    read ahead are held in memory.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    state = 'start'
+    while True:
+        match = JSON_WHITESPACE.match(buf, pos)
+        pos = match.end()
+        if pos == len(buf):
+            if eof:
+                raise ValueError("Unexpected end of JSON array.")
+            chunk = f.read(read_size)
+            buf, pos, eof = buf[pos:] + chunk, 0, not chunk
+            continue
+
+        char = buf[pos]
+        if state == 'start':
+            if char != '[':
+                raise ValueError("Expected a JSON array.")
+            pos += 1
+            state = 'first'
+            continue
+        if char == ']' and state != 'value':
+            return
+        if state == 'next':
+            if char != ',':
+                raise ValueError("Expected , or ] in JSON array.")
+            pos += 1
+            state = 'value'
+            continue
+
+        # A value only ends for certain where more input follows it.
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+                if end < len(buf) or eof:
+                    break
+            except ValueError:
+                if eof:
+                    raise
+            chunk = f.read(max(read_size, len(buf) - pos))
+            buf, pos, eof = buf[pos:] + chunk, 0, not chunk
+        yield value
+        pos = end
+        state = 'next'
+
+
+def iter_records(path):
+    """
+    Yield (name, data) records one at a time from a JSON Lines file, one
+    record per line, a .json file holding a JSON array of records, standard
+    input as JSON Lines if path is -, or a directory of JSON files in name
+    order. Each record is either a JSON array of fields or, with a template,
+    a JSON object of field values.
+    """
+    if os.path.isdir(path):
+        for filename in sorted(os.listdir(path)):
+            name, ext = os.path.splitext(filename)
+            if ext != '.json':
+                continue
+            with open(os.path.join(path, filename)) as f:
+                yield name, json.load(f)
+        return
+
+    if path == '-':
+        values = (json.loads(line) for line in sys.stdin if line.strip())
+        for index, data in enumerate(values):
+            yield "{:06d}".format(index), data
+        return
+
+    with open(path) as f:
+        if os.path.splitext(path)[1] == '.json':
+            values = iter_json_array(f)
+        else:
+            values = (json.loads(line) for line in f if line.strip())
+        for index, data in enumerate(values):
+            yield "{:06d}".format(index), data
+
+
+class RenderStats(object):
+    """
+    Per-document latency and throughput of a batch run.
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.failures = []
+        self.cached = 0
+        self.started = default_timer()
+        self.elapsed = 0.0
+
+    def add(self, latency, name=None, error=None, cached=False):
+        """
+        Record the latency of one rendered document, or the error if the
+        document failed, and whether it came from the result cache.
+        """
+        self.latencies.append(latency)
+        if error:
+            self.failures.append((name, error))
+        if cached:
+            self.cached += 1
+
+    def finish(self):
+        """
+        Stop the wall clock.
+        """
+        self.elapsed = default_timer() - self.started
+
+    def summary(self):
+        """
+        Return throughput and latency percentiles as a dict.
+        """
+        documents = len(self.latencies)
+        docs_per_sec = documents / self.elapsed if self.elapsed else 0.0
+        return {
+            'documents': documents,
+            'failures': len(self.failures),
+            'cached': self.cached,
+            'elapsed': self.elapsed,
+            'docs_per_sec': docs_per_sec,
+            'p50': percentile(self.latencies, 50),
+            'p99': percentile(self.latencies, 99),
+        }
+
+    def report(self):
+        """
+        Return a one line human readable summary.
+        """
+        summary = self.summary()
+        return ("{} documents ({} failed, {} cached) in {:.2f}s ({:.1f} "
+                "docs/sec), p50 {:.1f} ms, p99 {:.1f} ms\n").format(
+                summary['documents'], summary['failures'], summary['cached'],
+                summary['elapsed'],
+                summary['docs_per_sec'],
+                summary['p50'] * 1000, summary['p99'] * 1000)
+
+
+class RenderMetrics(object):
+    """
+    Time spent in each stage of rendering and counters such as fields drawn
+    by type and bytes read and written. Hooks are called with the metrics of
+    each render when it finishes, e.g. to export them to a metrics system.
+    """
+
+    def __init__(self):
+        self.hooks = []
+        self.last = None
+        self.reset()
+
+    def reset(self):
+        """
+        Start collecting metrics for the next render.
+        """
+        self.timings = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+
+    def add_hook(self, hook):
+        """
+        Call hook(metrics) after every render with the dict from summary().
+        """
+        self.hooks.append(hook)
+
+    def time(self, stage, seconds):
+        """
+        Record seconds spent in one call of stage.
+        """
+        self.timings[stage] += seconds
+        self.calls[stage] += 1
+
+    def count(self, counter, amount=1):
+        """
+        Add amount to counter.
+        """
+        self.counters[counter] += amount
+
+    def summary(self):
+        """
+        Return total seconds and calls by stage and counters as a dict.
+        """
+        return {
+            'timings': dict(self.timings),
+            'calls': dict(self.calls),
+            'counters': dict(self.counters),
+        }
+
+    def finish(self):
+        """
+        End a render. Pass its metrics to the hooks and start over.
+        """
+        self.last = self.summary()
+        self.reset()
+        for hook in self.hooks:
+            hook(self.last)
+        return self.last
+
+    def report(self, metrics=None):
+        """
+        Return a human readable per stage breakdown of metrics, by default
+        those of the last render.
+        """
+        metrics = metrics or self.last or self.summary()
+        timings = metrics['timings']
+        lines = ["{:<12} {:>6} {:>10}".format("stage", "calls", "ms")]
+        for stage in sorted(timings, key=timings.get, reverse=True):
+            lines.append("{:<12} {:>6} {:>10.3f}".format(stage,
+                    metrics['calls'][stage], timings[stage] * 1000))
+        for counter in sorted(metrics['counters']):
+            lines.append("{:<19} {:>10}".format(counter,
+                    metrics['counters'][counter]))
+        return "\n".join(lines) + "\n"
+
+
+class OutputStream(object):
+    """
+    Pass writes through to a file-like object, counting the bytes written.
+    PyPDF2 uses tell() for object offsets, which pipes and sockets do not
+    support.
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self.position = 0
+
+    def write(self, data):
+        """
+        Write data to the target.
+        """
+        self.target.write(data)
+        self.position += len(data)
+
+    def tell(self):
+        """
+        Bytes written so far.
+        """
+        return self.position
+
+
+class ContentCanvas(object):
+    """
+    The part of the reportlab Canvas used to draw text, line, outline and
+    preview fields, writing content stream operators straight to a list
+    instead of a document. The operators are the ones Canvas writes, so the
+    fields look the same either way. Text is set in the standard 14 fonts.
+    fonts maps the fonts used to their page resource names and may be
+    shared by the pages of a document.
+    """
+
+    def __init__(self, fonts):
+        self.fonts = fonts
+        self.code = []
+        self.font_face = None
+        self.font_size = None
+        self.states = []
+
+    def saveState(self):
+        self.code.append('q')
+        self.states.append((self.font_face, self.font_size))
+
+    def restoreState(self):
+        self.code.append('Q')
+        self.font_face, self.font_size = self.states.pop()
+
+    def translate(self, dx, dy):
+        self.code.append('1 0 0 1 {} cm'.format(fp_str(dx, dy)))
+
+    def rotate(self, theta):
+        c = cos(theta * pi / 180)
+        s = sin(theta * pi / 180)
+        self.code.append('{} cm'.format(fp_str(c, s, -s, c, 0, 0)))
+
+    def setLineWidth(self, width):
+        self.code.append('{} w'.format(fp_str(width)))
+
+    def setStrokeColorRGB(self, r, g, b):
+        self.code.append('{} RG'.format(fp_str(r, g, b)))
+
+    def setFillColorRGB(self, r, g, b):
+        self.code.append('{} rg'.format(fp_str(r, g, b)))
+
+    def setFont(self, font_face, font_size):
+        self.font_face = font_face
+        self.font_size = font_size
+
+    def drawString(self, x, y, text):
+        """
+        Draw text from (x, y). Characters the font does not have are set in
+        Symbol or ZapfDingbats, as Canvas does.
+        """
+        font = pdfmetrics.getFont(self.font_face)
+        code = ['BT 1 0 0 1 {} Tm'.format(fp_str(x, y))]
+        for sub, data in pdfmetrics.unicode2T1(text,
+                [font] + font.substitutionFonts):
+            code.append('{} {} Tf ({}) Tj'.format(self.font(sub.fontName),
+                    fp_str(self.font_size), escapePDF(data)))
+        code.append('ET')
+        self.code.append(' '.join(code))
+
+    def drawRightString(self, x, y, text):
+        self.drawString(x - pdfmetrics.stringWidth(text, self.font_face,
+                self.font_size), y, text)
+
+    def drawCentredString(self, x, y, text):
+        self.drawString(x - pdfmetrics.stringWidth(text, self.font_face,
+                self.font_size) / 2.0, y, text)
+
+    def line(self, x1, y1, x2, y2):
+        self.code.append('n {} m {} l S'.format(fp_str(x1, y1),
+                fp_str(x2, y2)))
+
+    def rect(self, x, y, width, height, stroke=1, fill=0):
+        self.code.append('n {} re {}'.format(fp_str(x, y, width, height),
+                canvas.PATH_OPS[stroke, fill, canvas.FILL_EVEN_ODD]))
+
+    def roundRect(self, x, y, width, height, radius, stroke=1, fill=0):
+        PDFPathObject(code=self.code).roundRect(x, y, width, height, radius)
+        self.code.append(canvas.PATH_OPS[stroke, fill, canvas.FILL_EVEN_ODD])
+
+    def font(self, font_face):
+        """
+        Resource name of a font.
+        """
+        name = self.fonts.get(font_face)
+        if name is None:
+            name = self.fonts[font_face] = FONT_NAME.format(len(self.fonts))
+        return name
+
+    def getvalue(self):
+        """
+        The content stream drawn so far.
+        """
+        return '\n'.join(self.code).encode('latin-1')
+
+
+def font_resource(font_face):
+    """
+    Font dictionary of a standard 14 font, encoded as Canvas encodes it.
+    """
+    font = DictionaryObject({
+        NameObject('/Type'): NameObject('/Font'),
+        NameObject('/Subtype'): NameObject('/Type1'),
+        NameObject('/BaseFont'): NameObject('/' + font_face),
+    })
+    encoding = pdfmetrics.getFont(font_face).encName
+    if encoding not in ('SymbolEncoding', 'ZapfDingbatsEncoding'):
+        font[NameObject('/Encoding')] = NameObject('/' + encoding)
+    return font
+
+
+class CombinedWriter(object):
+    """
+    Write filled forms into one PDF as they are rendered. Each page is
+    written when it is added and only object offsets are kept, so memory
+    stays flat however many forms are added. Objects of the base form, such
+    as fonts, images and page content, are written once and shared by every
+    copy of its pages. Each overlay is drawn on its page as a Form XObject
+    over the unchanged base page content. Identical overlay streams, such as
+    images, are also written once.
+    """
+
+    def __init__(self, target, header=b"%PDF-1.3\n%\xe2\xe3\xcf\xd3\n",
+            size=3):
+        self.stream = OutputStream(target)
+        self.offsets = {}
+        self.generations = {}
+        # Object numbers below size are taken. Objects 1 and 2 are the
+        # catalog and page tree.
+        self.size = size
+        self.pages_ref = IndirectObject(2, 0, None)
+        self.kids = []
+        self.shared = {}
+        self.streams = {}
+        self.stream.write(header)
+        self.wrap = [self.write_data(b"q\n"),
+                self.write_data(b"\nQ\nq " + OVERLAY_NAME.encode('ascii') +
+                b" Do Q\n")]
+
+    def share(self, reader):
+        """
+        Write objects of reader once however many pages use them.
+        """
+        self.shared.setdefault(reader, {})
+
+    def reserve(self):
+        """
+        Return the next free object number.
+        """
+        self.size += 1
+        return self.size - 1
+
+    def write_object(self, number, obj, generation=0):
+        """
+        Write obj as indirect object number.
+        """
+        self.offsets[number] = self.stream.tell()
+        if generation:
+            self.generations[number] = generation
+        self.stream.write("{} {} obj\n".format(number, generation).encode(
+                'ascii'))
+        obj.writeToStream(self.stream, None)
+        self.stream.write(b"\nendobj\n")
+
+    def write_data(self, data):
+        """
+        Write a compressed stream of data. Return a reference to it.
+        """
+        obj = EncodedStreamObject()
+        obj[NameObject('/Filter')] = NameObject('/FlateDecode')
+        obj._data = FlateDecode.encode(data)
+        return self.write_stream(obj)
+
+    def write_stream(self, obj):
+        """
+        Write a stream with its references already resolved, unless an
+        identical stream was written before. Return a reference to it.
+        """
+        data = CharIO()
+        obj.writeToStream(data, None)
+        data = data.getvalue()
+        digest = hashlib.md5(data).digest()
+        number = self.streams.get(digest)
+        if number is None:
+            number = self.streams[digest] = self.reserve()
+            self.offsets[number] = self.stream.tell()
+            self.stream.write("{} 0 obj\n".format(number).encode('ascii'))
+            self.stream.write(data)
+            self.stream.write(b"\nendobj\n")
+        return IndirectObject(number, 0, None)
+
+    def resolve(self, value, local):
+        """
+        Copy a direct object with the objects it refers to written and the
+        references renumbered. Objects of readers that are not shared are
+        numbered in local. Pages keep their place in the new page tree.
+        """
+        if isinstance(value, IndirectObject):
+            return self.reference(value, local)
+        if isinstance(value, StreamObject):
+            return self.write_stream(self.copy_stream(value, local))
+        if isinstance(value, DictionaryObject):
+            result = DictionaryObject()
+            for key, item in value.items():
+                if key == '/Parent' and value.get('/Type') == '/Page':
+                    result[key] = self.pages_ref
+                else:
+                    result[key] = self.resolve(item, local)
+            return result
+        if isinstance(value, ArrayObject):
+            return ArrayObject([self.resolve(x, local) for x in value])
+        return value
+
+    def copy_stream(self, obj, local):
+        """
+        Copy a stream with its dictionary resolved. The length is set when
+        it is written.
+        """
+        result = copy.copy(obj)
+        for key, item in obj.items():
+            if key != '/Length':
+                result[key] = self.resolve(item, local)
+        return result
+
+    def reference(self, ref, local):
+        """
+        Write the object ref refers to unless it was written already. Return
+        a reference to the written object.
+        """
+        key = (id(ref.pdf), ref.idnum, ref.generation)
+        refs = local
+        if key not in local and ref.pdf in self.shared:
+            refs = self.shared[ref.pdf]
+            key = key[1:]
+        number = refs.get(key)
+        if number is None:
+            obj = ref.getObject()
+            if isinstance(obj, StreamObject):
+                written = self.write_stream(self.copy_stream(obj, local))
+                refs[key] = written.idnum
+                return written
+            number = refs[key] = self.reserve()
+            self.write_object(number, self.resolve(obj, local))
+        return IndirectObject(number, 0, None)
+
+    def add_page(self, page, overlay_page=None):
+        """
+        Write a base form page, with an overlay page drawn over it if given.
+        """
+        number = self.reserve()
+        local = {}
+        if getattr(page, 'indirectRef', None) is not None:
+            ref = page.indirectRef
+            local[(id(ref.pdf), ref.idnum, ref.generation)] = number
+
+        result = self.resolve(page, local)
+        if overlay_page is not None:
+            self.add_overlay(page, result, overlay_page, local)
+        self.write_object(number, result)
+        self.kids.append(IndirectObject(number, 0, None))
+
+    def add_overlay(self, page, result, overlay_page, local):
+        """
+        Draw an overlay page over the written copy of page as a Form XObject
+        with its own resources. The base page content is left as it is.
+        """
+        contents = overlay_page['/Contents'].getObject()
+        if not isinstance(contents, ArrayObject):
+            contents = [contents]
+        form = EncodedStreamObject()
+        form._data = FlateDecode.encode(b"\n".join(x.getObject().getData()
+                for x in contents))
+        form.update({
+            NameObject('/Type'): NameObject('/XObject'),
+            NameObject('/Subtype'): NameObject('/Form'),
+            NameObject('/Filter'): NameObject('/FlateDecode'),
+            NameObject('/BBox'): ArrayObject(overlay_page.mediaBox),
+            NameObject('/Resources'): self.resolve(
+                    overlay_page['/Resources'], local),
+        })
+
+        original = page.get('/Resources', DictionaryObject()).getObject()
+        resources = self.resolve(original, local)
+        xobjects = original.get('/XObject', DictionaryObject()).getObject()
+        xobjects = self.resolve(xobjects, local)
+        xobjects[NameObject(OVERLAY_NAME)] = self.write_stream(form)
+        resources[NameObject('/XObject')] = xobjects
+        result[NameObject('/Resources')] = resources
+
+        base = []
+        if '/Contents' in page:
+            base = page['/Contents']
+            if isinstance(base, ArrayObject):
+                base = self.resolve(base, local)
+            else:
+                base = [result.raw_get('/Contents')]
+        result[NameObject('/Contents')] = ArrayObject(
+                [self.wrap[0]] + list(base) + [self.wrap[1]])
+
+    def close(self):
+        """
+        Write the page tree, catalog and cross-reference table.
+        """
+        self.write_object(2, DictionaryObject({
+            NameObject('/Type'): NameObject('/Pages'),
+            NameObject('/Kids'): ArrayObject(self.kids),
+            NameObject('/Count'): NumberObject(len(self.kids)),
+        }))
+        self.write_object(1, DictionaryObject({
+            NameObject('/Type'): NameObject('/Catalog'),
+            NameObject('/Pages'): self.pages_ref,
+        }))
+
+        self.offsets[0] = None
+        self.write_xref(DictionaryObject({
+            NameObject('/Size'): NumberObject(self.size),
+            NameObject('/Root'): IndirectObject(1, 0, None),
+        }))
+
+    def xref_sections(self):
+        """
+        Yield (first object number, [object numbers]) for each run of
+        consecutive object numbers written.
+        """
+        numbers = sorted(self.offsets)
+        start = 0
+        for i in range(1, len(numbers) + 1):
+            if i == len(numbers) or numbers[i] != numbers[i - 1] + 1:
+                yield numbers[start], numbers[start:i]
+                start = i
+
+    def write_xref(self, trailer):
+        """
+        Write the cross-reference table of the objects written and the
+        trailer.
+        """
+        xref = self.stream.tell()
+        self.stream.write(b"xref\n")
+        for first, numbers in self.xref_sections():
+            self.stream.write("{} {}\n".format(first, len(numbers)).encode(
+                    'ascii'))
+            for number in numbers:
+                if self.offsets[number] is None:
+                    self.stream.write(b"0000000000 65535 f \n")
+                else:
+                    self.stream.write("{:010d} {:05d} n \n".format(
+                            self.offsets[number], self.generations.get(
+                            number, 0)).encode('ascii'))
+        self.stream.write(b"trailer\n")
+        trailer.writeToStream(self.stream, None)
+        self.stream.write("\nstartxref\n{}\n%%EOF\n".format(xref).encode(
+                'ascii'))
+
+
+class IncrementalWriter(CombinedWriter):
+    """
+    Draw overlays onto a base form as an incremental update. The base form
+    bytes are written as they are, followed by the overlay objects, the
+    changed page dictionaries under their original numbers and a
+    cross-reference section for just those objects. Objects of the base form
+    are referred to, never copied, so the output grows with the fields drawn
+    rather than the size of the form.
+    """
+
+    def __init__(self, target, reader, data):
+        if '/Encrypt' in reader.trailer:
+            raise Exception("Incremental output of encrypted forms is not "
+                    "supported.")
+        self.reader = reader
+        tail = data.rfind(b'startxref')
+        self.prev = int(data[tail + 9:].split()[0])
+        self.xref_stream = data[self.prev:self.prev + 4] != b'xref'
+        if data[-1:] not in (b'\n', b'\r'):
+            data = data[:] + b'\n'
+        # The reader keeps the /Size of the oldest trailer, not the newest.
+        numbers = [x for section in reader.xref.values() for x in section]
+        numbers.extend(reader.xref_objStm)
+        CombinedWriter.__init__(self, target, data, max(numbers +
+                [int(reader.trailer['/Size']) - 1]) + 1)
+
+    def reference(self, ref, local):
+        """
+        Keep references to objects of the base form.
+        """
+        if ref.pdf is self.reader:
+            return IndirectObject(ref.idnum, ref.generation, None)
+        return CombinedWriter.reference(self, ref, local)
+
+    def add_page(self, page, overlay_page=None):
+        """
+        Write a changed copy of base form page with an overlay page drawn
+        over it. Unchanged pages need not be written.
+        """
+        ref = page.indirectRef
+        result = DictionaryObject(page.items())
+        if overlay_page is not None:
+            self.add_overlay(page, result, overlay_page, {})
+        self.write_object(ref.idnum, result, ref.generation)
+
+    def close(self):
+        """
+        Write the cross-reference section and a trailer pointing back to the
+        base form's. Base forms ending in a cross-reference stream get one
+        too.
+        """
+        self.offsets[0] = None
+        trailer = DictionaryObject({
+            NameObject('/Size'): NumberObject(self.size),
+            NameObject('/Prev'): NumberObject(self.prev),
+        })
+        for key in ('/Root', '/Info', '/ID'):
+            if key in self.reader.trailer:
+                trailer[NameObject(key)] = self.resolve(
+                        self.reader.trailer.raw_get(key), {})
+        if self.xref_stream:
+            self.write_xref_stream(trailer)
+        else:
+            self.write_xref(trailer)
+
+    def write_xref_stream(self, trailer):
+        """
+        Write the cross-reference section as a cross-reference stream with
+        the trailer entries in its dictionary.
+        """
+        number = self.reserve()
+        xref = self.offsets[number] = self.stream.tell()
+        index = ArrayObject()
+        rows = []
+        for first, numbers in self.xref_sections():
+            index.extend([NumberObject(first), NumberObject(len(numbers))])
+            for x in numbers:
+                if self.offsets[x] is None:
+                    rows.append(struct.pack('>BIH', 0, 0, 65535))
+                else:
+                    rows.append(struct.pack('>BIH', 1, self.offsets[x],
+                            self.generations.get(x, 0)))
+        obj = EncodedStreamObject()
+        obj._data = FlateDecode.encode(b"".join(rows))
+        obj.update(trailer)
+        obj.update({
+            NameObject('/Type'): NameObject('/XRef'),
+            NameObject('/Size'): NumberObject(self.size),
+            NameObject('/Index'): index,
+            NameObject('/W'): ArrayObject([NumberObject(1),
+                    NumberObject(4), NumberObject(2)]),
+            NameObject('/Filter'): NameObject('/FlateDecode'),
+        })
+        self.write_object(number, obj)
+        self.stream.write("startxref\n{}\n%%EOF\n".format(xref).encode(
+                'ascii'))
+
+
+class BaseForm(object):
+    """
+    A parsed base form along with what every render needs to know about it.
+    docbuf is a file-like object or a memory map of the form file. Objects
+    are parsed from it as they are first used.
+    """
+
+    def __init__(self, docbuf, size):
+        self.docbuf = docbuf
+        self.size = size
+        self.reader = PdfFileReader(docbuf, strict=False)
+        self.pages = self.reader.getNumPages()
+        self.pagesize = self.reader.getPage(0).mediaBox.upperRight
+        self.sha256 = None
+        self.fields = None
+
+    def digest(self):
+        """
+        SHA-256 of the form file, computed once.
+        """
+        if self.sha256 is None:
+            self.sha256 = hashlib.sha256(self.data()).hexdigest()
+        return self.sha256
+
+    def data(self):
+        """
+        The bytes of the form file. A memory map is returned as it is, so
+        nothing is copied.
+        """
+        if isinstance(self.docbuf, mmap.mmap):
+            return self.docbuf
+        return self.docbuf.getvalue()
+
+    def acroform(self):
+        """
+        The form's AcroForm fields, indexed once.
+        """
+        if self.fields is None:
+            self.fields = AcroForm(self.reader)
+        return self.fields
+
+
+class AcroFormField(object):
+    """
+    A terminal AcroForm field: its fully qualified name, its field
+    dictionary, the attributes it inherits and its widget annotations.
+    """
+
+    def __init__(self, name, ref, attributes, widgets):
+        self.name = name
+        self.ref = ref
+        self.attributes = attributes
+        self.widgets = widgets
+
+
+class AcroForm(object):
+    """
+    The interactive form of a base form. Fields are indexed by fully
+    qualified name. nodes holds every dictionary of the field tree, widgets
+    included, so a render can copy the whole tree.
+    """
+    INHERITED = ('/FT', '/Ff', '/DA', '/Q',)
+
+    def __init__(self, reader):
+        self.form = reader.trailer['/Root'].get('/AcroForm')
+        self.nodes = []
+        self.fields = OrderedDict()
+        if self.form is None:
+            return
+        self.form = self.form.getObject()
+        for ref in self.form['/Fields']:
+            self.add(ref, None, {})
+
+    def add(self, ref, parent, attributes):
+        """
+        Index a field dictionary and its kids.
+        """
+        node = ref.getObject()
+        self.nodes.append(ref)
+        name = node.get('/T')
+        if name is not None and parent is not None:
+            name = '{}.{}'.format(parent, name)
+        elif name is None:
+            name = parent
+        attributes = dict(attributes)
+        for key in self.INHERITED:
+            if key in node:
+                attributes[key] = node[key]
+
+        kids = node.get('/Kids', ArrayObject()).getObject()
+        if any('/T' in x.getObject() for x in kids):
+            for kid in kids:
+                self.add(kid, name, attributes)
+            return
+        # Kids without names are the widgets of this field.
+        self.nodes.extend(kids)
+        self.fields[name] = AcroFormField(name, ref, attributes,
+                list(kids) or [ref])
+
+    def value(self, field, widget, key, default=None):
+        """
+        A variable text attribute of a widget, inherited from its field or
+        the form.
+        """
+        if key in widget:
+            return widget[key]
+        return field.attributes.get(key, self.form.get(key, default))
+
+
+class BaseFormCache(object):
+    """
+    Parsed base forms keyed by path, modification time and size. The least
+    recently used forms are evicted once the combined size of the cached form
+    files exceeds max_bytes. Form files are memory mapped unless mapped is
+    false, so worker processes share one copy of each form in the page cache
+    and only the parts of it a render touches are paged in.
+    """
+
+    def __init__(self, max_bytes=BASE_FORM_CACHE_BYTES, mapped=True):
+        self.max_bytes = max_bytes
+        self.mapped = mapped
+        self.forms = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        """
+        Return the parsed BaseForm for path. Read and parse it on a miss.
+        """
+        st = os.stat(path)
+        key = (os.path.abspath(path), st.st_mtime, st.st_size)
+        with self.lock:
+            form = self.forms.pop(key, None)
+            if form is not None:
+                self.hits += 1
+                self.forms[key] = form
+                return form
+            self.misses += 1
+
+        # A form file must be replaced, not rewritten in place, while it
+        # is mapped.
+        with open(path, 'rb') as f:
+            data = map_file(f) if self.mapped else None
+            docbuf = data
+            if data is None:
+                data = f.read()
+                docbuf = CharIO(data)
+        form = BaseForm(docbuf, len(data))
+
+        with self.lock:
+            if key not in self.forms:
+                self.forms[key] = form
+                self.size += form.size
+            while self.size > self.max_bytes and self.forms:
+                _, evicted = self.forms.popitem(last=False)
+                self.size -= evicted.size
+                self.evictions += 1
+        return form
+
+    def clear(self):
+        """
+        Drop every cached form. Counters are kept.
+        """
+        with self.lock:
+            self.forms.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        Return cache counters as a dict.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.forms),
+            'bytes': self.size,
+        }
+
+
+# Shared by every FormRenderer in the process unless one is given.
+BASE_FORM_CACHE = BaseFormCache()
+
+
+class CachedImage(object):
+    """
+    An image loaded and encoded once as a reportlab image XObject, ready to
+    be embedded in any number of documents.
+    """
+
+    def __init__(self, path, key):
+        self.key = key
+        self.name = hashlib.md5(repr(key).encode('utf-8')).hexdigest()
+        self.xobject = pdfdoc.PDFImageXObject(self.name, path)
+        self.width = self.xobject.width
+        self.height = self.xobject.height
+        self.size = len(self.xobject.streamContent)
+
+
+class ImageCache(object):
+    """
+    Encoded images keyed by path, modification time and size. The least
+    recently used images are evicted once the combined size of their encoded
+    data exceeds max_bytes.
+    """
+
+    def __init__(self, max_bytes=IMAGE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.images = OrderedDict()
+        self.digests = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def digest(self, path):
+        """
+        Return the SHA-256 of the image file at path. It is computed once
+        per path, modification time and size, for the IMAGE_DIGESTS_MAX most
+        recently used.
+        """
+        st = os.stat(path)
+        key = (os.path.abspath(path), st.st_mtime, st.st_size)
+        with self.lock:
+            digest = self.digests.pop(key, None)
+            if digest is not None:
+                self.digests[key] = digest
+                return digest
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).digest()
+        with self.lock:
+            self.digests[key] = digest
+            while len(self.digests) > IMAGE_DIGESTS_MAX:
+                self.digests.popitem(last=False)
+        return digest
+
+    def get(self, path):
+        """
+        Return the CachedImage for path. Load and encode it on a miss.
+        """
+        st = os.stat(path)
+        key = (os.path.abspath(path), st.st_mtime, st.st_size)
+        with self.lock:
+            image = self.images.pop(key, None)
+            if image is not None:
+                self.hits += 1
+                self.images[key] = image
+                return image
+            self.misses += 1
+
+        image = CachedImage(path, key)
+        self.add(image)
+        return image
+
+    def add(self, image):
+        """
+        Cache a CachedImage loaded elsewhere, such as from a bundle.
+        """
+        with self.lock:
+            if image.key not in self.images:
+                self.images[image.key] = image
+                self.size += image.size
+            while self.size > self.max_bytes and self.images:
+                _, evicted = self.images.popitem(last=False)
+                self.size -= evicted.size
+                self.evictions += 1
+
+    def stats(self):
+        """
+        Return cache counters as a dict.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.images),
+            'bytes': self.size,
+        }
+
+
+# Shared by every FormRenderer in the process unless one is given.
+IMAGE_CACHE = ImageCache()
+
+
+class ResultCache(object):
+    """
+    Filled forms on disk keyed by a hash of everything they depend on. See
+    FormRenderer.result_key(). Entries are written to a temporary file and
+    renamed into place, so processes can share the directory and never read
+    a partial entry. Once the entries exceed max_bytes the least recently
+    used are removed.
+    """
+
+    def __init__(self, directory, max_bytes=RESULT_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Measured on the first store, see put().
+        self.size = None
+
+    def path(self, key):
+        """
+        File name of the entry for key.
+        """
+        return os.path.join(self.directory, key[:2], key + '.pdf')
+
+    def get(self, key):
+        """
+        Return the filled form stored for key, or None.
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                pdf = f.read()
+            # The modification time orders entries for eviction.
+            os.utime(path, None)
+        except (IOError, OSError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return pdf
+
+    def put(self, key, pdf):
+        """
+        Store the filled form for key. Evict if the cache is full.
+        """
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass    # Made by another process.
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(pdf)
+            os.replace(temp_path, path)
+        except Exception:
+            os.unlink(temp_path)
+            raise
+
+        # Only stores need the size of the cache, so lookups never wait for
+        # a scan of the directory.
+        size = None
+        if self.size is None:
+            size = sum(x[1] for x in self.entries())
+        with self.lock:
+            self.stores += 1
+            if self.size is None:
+                self.size = size
+            else:
+                self.size += len(pdf)
+            full = self.size > self.max_bytes
+        if full:
+            self.evict()
+
+    def entries(self):
+        """
+        Yield (modification time, size, path) of every entry.
+        """
+        for subdir in os.listdir(self.directory):
+            subdir = os.path.join(self.directory, subdir)
+            if not os.path.isdir(subdir):
+                continue
+            for filename in os.listdir(subdir):
+                if not filename.endswith('.pdf'):
+                    continue
+                path = os.path.join(subdir, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue    # Evicted by another process.
+                yield st.st_mtime, st.st_size, path
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is at most
+        RESULT_CACHE_LOW_WATER full. The size is measured on disk since other
+        processes add and remove entries too.
+        """
+        entries = sorted(self.entries())
+        size = sum(x[1] for x in entries)
+        evictions = 0
+        for _, entry_size, path in entries:
+            if size <= self.max_bytes * RESULT_CACHE_LOW_WATER:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            size -= entry_size
+            evictions += 1
+        with self.lock:
+            self.size = size
+            self.evictions += evictions
+
+    def stats(self):
+        """
+        Return cache counters and the hit rate as a dict. Bytes are None
+        until the first store.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            'bytes': self.size,
+        }
+
+
+class CompiledField(object):
+    """
+    A field with its position, color and draw point validated and resolved
+    once so that rendering it only needs the value. Built by
+    FormRenderer.compile_field() as the subclass for the field type.
+    """
+    __slots__ = ('page', 'position', 'rotation', 'line_width', 'rgb',
+            'draw_point', 'draw',)
+    kind = None
+    required = ('page', 'x', 'y', 'width', 'height',)
+
+
+class TextField(CompiledField):
+    """
+    A text field with its font and fitting resolved as well.
+    """
+    __slots__ = ('font_face', 'font_size', 'metrics', 'ascent', 'align',
+            'fit', 'min_font_size',)
+    kind = 'text'
+    required = CompiledField.required + ('font_face', 'font_size',
+            'align_horizontal',)
+
+
+class ImageField(CompiledField):
+    """
+    An image field. The value is the path to the image.
+    """
+    __slots__ = ()
+    kind = 'image'
+
+
+class OutlineField(CompiledField):
+    """
+    A rounded rectangle around the field.
+    """
+    __slots__ = ()
+    kind = 'outline'
+
+
+class LineField(CompiledField):
+    """
+    A line from the field origin to the opposite corner.
+    """
+    __slots__ = ()
+    kind = 'line'
+
+
+FIELD_TYPES = dict((x.kind, x) for x in (TextField, ImageField,
+        OutlineField, LineField))
+
+
+def describe_field(field):
+    """
+    Name a field in error messages by its name, comment or page.
+    """
+    label = field.get('name') or field.get('comment')
+    if label:
+        return "Field '{}'".format(label)
+    return "Field on page {}".format(field.get('page'))
+
+
+def write_bundle(bundle, path):
+    """
+    Write a FormRenderer.bundle() to a file, after a header with the bundle
+    format version.
+    """
+    with open(path, 'wb') as f:
+        pickle.dump((BUNDLE_MAGIC, BUNDLE_VERSION), f, 2)
+        pickle.dump(bundle, f, pickle.HIGHEST_PROTOCOL)
+
+
+def read_bundle(path):
+    """
+    Read a bundle written by write_bundle(). Bundles are pickles, so only
+    read bundles you compiled yourself.
+    """
+    with open(path, 'rb') as f:
+        try:
+            header = pickle.load(f)
+        except (pickle.UnpicklingError, EOFError, ValueError):
+            header = None
+        if header != (BUNDLE_MAGIC, BUNDLE_VERSION):
+            raise Exception("{} is not a bundle compiled by this version of "
+                    "filler. Compile it again.".format(path))
+        return pickle.load(f)
+
+
+class FormRenderer(object):
+    """
+    Render JSON defined fields on PDF document.
+    """
+
+    def __init__(self, base_form, form_data_file, output_file,
+            extra_data_file=None, preview=None, form_cache=None,
+            template_file=None, image_cache=None, result_cache=None,
+            acroform=False, flatten=False, incremental=False,
+            direct=False, bundle_file=None):
+        # XXX: We don't validate these files...
+        self.base_form = base_form
+        self.output_file = output_file
+        self.preview = preview
+        self.acroform = acroform or flatten
+        self.flatten = flatten
+        self.incremental = incremental
+        self.direct = direct
+        if self.acroform and incremental:
+            raise Exception("Incremental output cannot fill AcroForm "
+                    "fields.")
+        self.form_cache = form_cache or BASE_FORM_CACHE
+        self.image_cache = image_cache or IMAGE_CACHE
+        self.result_cache = result_cache
+        self.cache_hit = False
+        self.form = None
+        self.compiled = {}
+        self.metrics = RenderMetrics()
+        self.bundle_file = bundle_file
+        self.stamp_key = None
+        self.prestamped = None
+
+        self.template = None
+        self.layout = {}
+        if bundle_file:
+            self.load_bundle(bundle_file)
+        else:
+            extra_data = []
+            if extra_data_file:
+                extra_data = self.load_json(extra_data_file)
+            self.set_extra_data(extra_data)
+            if template_file:
+                self.load_template(self.load_json(template_file))
+
+        # Batch renders have no form data up front. See render_batch().
+        form_data = {} if self.template is not None else []
+        if form_data_file:
+            form_data = self.load_json(form_data_file)
+
+        self.set_form_data(form_data)
+
+    def load_json(self, filename):
+        """
+        Read a JSON file.
+        """
+        start = default_timer()
+        with open(filename) as f:
+            data = f.read()
+        self.metrics.count('bytes_read', len(data))
+        data = json.loads(data)
+        self.metrics.time('load', default_timer() - start)
+        return data
+
+    def set_extra_data(self, extra_data):
+        """
+        Extra data fields are the same on every form. Unless marked
+        `"static": false' they are drawn once onto a stamped copy of the base
+        form rather than on every render.
+        """
+        self.extra_data = extra_data
+        self.dynamic_extra = [x for x in extra_data
+                if not x.get('static', True)]
+        self.set_static_fields([x for x in extra_data
+                if x.get('static', True)])
+
+    def set_static_fields(self, fields):
+        """
+        Compile the fields drawn onto the stamped base form. The base form is
+        stamped again on the next render.
+        """
+        self.static_plan = index_by_page([(self.compile_field(x),
+                field_value(x) or '') for x in fields])
+        self.stamped_from = None
+        self.stamped = None
+        self.layout_key = None
+
+    def load_template(self, template):
+        """
+        Compile the template fields and extra data fields once. Template
+        fields with a `name' take their value from each record. The `data'
+        or `text' attribute is the value used when a record has none. Fields
+        without a name are static unless marked `"static": false'.
+        """
+        self.template = template
+        fields = [x for x in template] + self.extra_data
+
+        static = [x for x in fields
+                if x.get('static', x.get('name') is None)]
+        self.set_static_fields(static)
+        self.layout = index_by_page(
+                [(self.compile_field(x), x.get('name'), field_value(x) or '')
+                for x in fields if not x.get('static', x.get('name') is None)])
+
+    def load_bundle(self, bundle_file):
+        """
+        Take the base form, template and extra data, all compiled, from a
+        bundle written by write_bundle(). The base form is not stamped again
+        unless it changed since.
+        """
+        start = default_timer()
+        bundle = read_bundle(bundle_file)
+        for name in BUNDLE_ATTRIBUTES:
+            setattr(self, name, bundle[name])
+        self.stamped_from = None
+        self.stamped = None
+        self.layout_key = None
+        self.set_stamped_form(bundle['stamped'], bundle['base_key'])
+        for field in self.compiled.values():
+            if field.kind == 'text':
+                _font_metrics.setdefault(field.font_face, field.metrics)
+        for image in bundle['images']:
+            self.image_cache.add(image)
+        self.metrics.time('load', default_timer() - start)
+
+    def bundle(self):
+        """
+        Everything loading the template and extra data resolved, as a dict
+        for write_bundle(): the compiled fields with their font metrics
+        measured for Latin-1 text, the images they draw by default and the
+        base form stamped with the static fields.
+        """
+        stamped = None
+        if self.static_plan:
+            self.load_base_form()
+            stamped = bytes(self.stamped.data())
+        images = []
+        entries = [(field, default) for entries in self.layout.values()
+                for field, _, default in entries]
+        entries += [(self.compile_field(x), field_value(x))
+                for x in self.dynamic_extra]
+        for field, value in entries:
+            if field.kind == 'image' and value:
+                images.append(self.image_cache.get(value))
+        for field in self.compiled.values():
+            if field.kind == 'text':
+                for char in BUNDLE_GLYPHS:
+                    field.metrics.glyph_width(char)
+
+        st = os.stat(self.base_form)
+        bundle = dict((x, getattr(self, x)) for x in BUNDLE_ATTRIBUTES)
+        bundle.update(base_form=os.path.abspath(self.base_form),
+                base_key=(st.st_mtime, st.st_size), stamped=stamped,
+                images=images)
+        return bundle
+
+    def set_form_data(self, form_data):
+        """
+        Set the data for the next render. A list is form data fields. A
+        mapping is field name to value for the template.
+        """
+        if isinstance(form_data, dict):
+            self.set_values(form_data)
+        else:
+            self.set_fields(form_data)
+
+    def set_values(self, values):
+        """
+        Bind a record of field name to value onto the compiled template.
+        Names the template does not use are ignored. When filling AcroForm
+        fields, names of the base form's fields are filled natively instead,
+        template or not.
+        """
+        native = self.acroform_fields()
+        if self.template is None and not self.acroform:
+            raise Exception("Field values given without a template.")
+        self.form_data = values
+        self.native = dict((name, value) for name, value in values.items()
+                if name in native)
+        self.plan = {}
+        for page, entries in self.layout.items():
+            for field, name, default in entries:
+                if name in native:
+                    self.native.setdefault(name, default)
+                else:
+                    self.plan.setdefault(page, []).append(
+                            (field, values.get(name, default)))
+
+    def set_fields(self, form_data):
+        """
+        Combine form data fields with extra data fields by page. Pair each
+        compiled field that is not static with its value in the render plan.
+        When filling AcroForm fields, fields named after one of the base
+        form's fields are filled natively instead.
+        """
+        native = self.acroform_fields()
+        self.form_data = form_data
+        self.native = dict((x['name'], field_value(x)) for x in form_data
+                if x.get('name') in native)
+        self.plan = index_by_page(
+                [(self.compile_field(x), field_value(x))
+                for x in form_data + self.dynamic_extra
+                if x.get('name') not in native])
+
+    def acroform_fields(self):
+        """
+        The base form's AcroForm fields by name when filling them natively,
+        otherwise an empty mapping.
+        """
+        if not self.acroform:
+            return {}
+        return self.form_cache.get(self.base_form).acroform().fields
+
+    def load_base_form(self):
+        """
+        Fetch the parsed base form from the form cache. The file is only read
+        and parsed again if it changed since it was cached. With static
+        fields, use the base form stamped with them instead.
+        """
+        start = default_timer()
+        stamp = self.stamps()
+        form = self.prestamped_form() if stamp else None
+        if form is None:
+            misses = self.form_cache.misses
+            form = self.form_cache.get(self.base_form)
+            if self.form_cache.misses != misses:
+                self.metrics.count('bytes_read', form.size)
+            if stamp:
+                if self.stamped_from is not form:
+                    self.stamped = self.stamp_base_form(form)
+                    self.stamped_from = form
+                form = self.stamped
+        self.use_base_form(form)
+        self.metrics.time('base_form', default_timer() - start)
+
+    def stamps(self):
+        """
+        Whether the base form is stamped with the static fields. Stamping
+        would drop the AcroForm and rewrite the base form that incremental
+        output must keep as is, see fill_plan().
+        """
+        return bool(self.static_plan) and not (self.acroform or
+                self.incremental)
+
+    def set_stamped_form(self, stamped, key):
+        """
+        Use a base form stamped ahead of time instead of stamping it again:
+        the stamped PDF as bytes, or the name of a file holding it. key is
+        the (mtime, size) of the base form file it was stamped from.
+        """
+        self.prestamped = stamped
+        self.stamp_key = key
+
+    def prestamped_form(self):
+        """
+        The base form as stamped ahead of time, parsed on first use. None
+        if there is none, or once the base form file has changed since and
+        must be stamped again. A stamped form file is mapped through the
+        form cache, so batch and service workers share one copy of it.
+        """
+        if self.prestamped is None:
+            return None
+        st = os.stat(self.base_form)
+        if (st.st_mtime, st.st_size) != self.stamp_key:
+            self.prestamped = None
+            return None
+        if isinstance(self.prestamped, str):
+            return self.form_cache.get(self.prestamped)
+        if not isinstance(self.prestamped, BaseForm):
+            self.prestamped = BaseForm(CharIO(self.prestamped),
+                    len(self.prestamped))
+        return self.prestamped
+
+    def write_stamped_form(self, directory):
+        """
+        Write the base form stamped with the static fields to a new file in
+        directory, for set_stamped_form() in worker processes. Return the
+        file name and the key of the base form, or None if the base form is
+        not stamped.
+        """
+        if not self.stamps():
+            return None
+        st = os.stat(self.base_form)
+        self.load_base_form()
+        fd, path = tempfile.mkstemp(suffix='.pdf', dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.base.data())
+        return path, (st.st_mtime, st.st_size)
+
+    def use_base_form(self, form):
+        """
+        Render onto the given BaseForm.
+        """
+        self.base = form
+        self.docbuf = form.docbuf
+        self.form = form.reader
+        self.pages = form.pages
+        self.pagesize = form.pagesize
 
-LEFT = 'left'
-RIGHT = 'right'
-CENTER = 'center'
-PREVIEW_COLOR = (0x20, 0xF0, 0x90,)
-PI = 3.14159
+    def stamp_base_form(self, form):
+        """
+        Draw the static fields onto the base form once. Return the stamped
+        form as a new BaseForm. Stamping is timed as its own stage; what it
+        draws and merges is not counted as part of the render.
+        """
+        start = default_timer()
+        metrics = self.metrics
+        self.metrics = RenderMetrics()
+        try:
+            self.use_base_form(form)
+            output = self.merge_overlay(*self.render_overlay(
+                    self.static_plan))
+            stampedbuf = CharIO()
+            output.write(stampedbuf)
+        finally:
+            self.metrics = metrics
+        self.metrics.time('stamp', default_timer() - start)
+        return BaseForm(stampedbuf, stampedbuf.tell())
+
+    def render_batch(self, records, output_dir, output_pattern=OUTPUT_PATTERN,
+            workers=1, chunksize=1):
+        """
+        Render each (name, fields) record to its own file in output_dir. The
+        base form is parsed once and shared by all records. With more than
+        one worker, records are fanned out to a process pool where each
+        worker holds its own parsed base form, see run_jobs(). Output names
+        and result order follow the input order. A failed record is recorded
+        in the returned RenderStats and does not stop the run.
+        """
+        jobs = ((index, name, form_data, os.path.join(output_dir,
+                    output_pattern.format(index=index, name=name)))
+                for index, (name, form_data) in enumerate(records))
 
-class FormRenderer(object):
-    """
-    Render JSON defined fields on PDF document.
-    """
+        stats = RenderStats()
+        for result in self.run_jobs('render_job', jobs, workers, chunksize):
+            stats.add(*result)
+        stats.finish()
+        return stats
 
-    def __init__(self, base_form, form_data_file, output_file,
-            extra_data_file=None, preview=None):
-        # XXX: We don't validate these files...
-        self.base_form = base_form
-        self.output_file = output_file
-        self.preview = preview
+    def render_combined(self, records, target, workers=1, chunksize=1):
+        """
+        Render every (name, fields) record into one PDF written to target, a
+        file name or writable file-like object. Pages are written as records
+        are rendered and share the base form's objects, see CombinedWriter.
+        Workers only draw overlays; pages are written in input order by this
+        process. Failed records are left out and recorded in the returned
+        RenderStats.
+        """
+        if self.acroform or self.incremental:
+            raise Exception("Combined output cannot fill AcroForm fields "
+                    "or be written incrementally.")
+        if isinstance(target, str):
+            with open(target, 'wb') as output_file:
+                return self.render_combined(records, output_file, workers,
+                        chunksize)
+
+        jobs = ((index, name, form_data)
+                for index, (name, form_data) in enumerate(records))
+        writer = CombinedWriter(target)
+        stats = RenderStats()
+        for latency, name, error, overlay, overlay_pages in self.run_jobs(
+                'overlay_job', jobs, workers, chunksize):
+            start = default_timer()
+            if not error:
+                try:
+                    self.add_combined(writer, overlay, overlay_pages)
+                except Exception as e:
+                    error = "{}: {}".format(e.__class__.__name__, e)
+            stats.add(latency + default_timer() - start, name, error)
+        writer.close()
+        stats.finish()
+        return stats
+
+    def add_combined(self, writer, overlay, overlay_pages):
+        """
+        Add a copy of every base form page with its overlay page, if any,
+        to a CombinedWriter. The overlay is a rendered overlay PDF.
+        """
+        self.load_base_form()
+        writer.share(self.form)
+        if overlay is not None:
+            overlay = PdfFileReader(CharIO(overlay), strict=False)
+        for i in range(self.pages):
+            overlay_page = None
+            if i in overlay_pages:
+                overlay_page = overlay.getPage(overlay_pages[i])
+            writer.add_page(self.form.getPage(i), overlay_page)
+        self.metrics.count('pages', self.pages)
+        self.metrics.count('pages_merged', len(overlay_pages))
+        self.metrics.finish()
+
+    def run_jobs(self, method, jobs, workers=1, chunksize=1):
+        """
+        Yield the result of the named method for each job in input order.
+        With more than one worker, jobs are fanned out to a process pool
+        where each worker holds its own parsed base form. Jobs are read from
+        the iterable only as workers need them, so at most BATCH_WINDOW
+        chunks per worker are in memory at once.
+        """
+        if workers <= 1:
+            for job in jobs:
+                yield getattr(self, method)(job)
+            return
+
+        result_cache = None
+        if self.result_cache is not None:
+            result_cache = (self.result_cache.directory,
+                    self.result_cache.max_bytes)
+        # Stamp once here so the workers map one stamped form file.
+        stamp_dir = tempfile.mkdtemp(prefix='filler-')
+        try:
+            stamped = self.write_stamped_form(stamp_dir)
+        except Exception:
+            # The workers report it for each job.
+            stamped = None
+        pool = multiprocessing.Pool(workers, _init_worker,
+                (self.base_form, self.extra_data, self.template,
+                self.preview, result_cache, self.acroform, self.flatten,
+                self.incremental, self.direct, self.bundle_file, stamped))
+        # Pool.imap() would read every record up front.
+        pending = deque()
+        try:
+            while True:
+                chunk = list(islice(jobs, chunksize))
+                if chunk:
+                    pending.append(pool.apply_async(_render_jobs,
+                            (method, chunk)))
+                if pending and (not chunk or
+                        len(pending) >= workers * BATCH_WINDOW):
+                    for result in pending.popleft().get():
+                        yield result
+                elif not chunk:
+                    break
+        finally:
+            pool.close()
+            pool.join()
+            shutil.rmtree(stamp_dir, ignore_errors=True)
 
-        with open(form_data_file) as f:
-            form_data = json.load(f)
-        if extra_data_file:
-            with open(extra_data_file) as f:
-                extra_data = json.load(f)
+    def render_job(self, job):
+        """
+        Render one (index, name, fields, output_file) batch job. Return
+        (latency, name, error, cached) where error is None on success and
+        cached is whether it came from the result cache.
+        """
+        _, name, form_data, output_file = job
+        start = default_timer()
+        error = None
+        self.cache_hit = False
+        try:
+            self.set_form_data(form_data)
+            self.output_file = output_file
+            self.render()
+        except Exception as e:
+            error = "{}: {}".format(e.__class__.__name__, e)
+        return (default_timer() - start, name, error, self.cache_hit)
+
+    def overlay_job(self, job):
+        """
+        Draw the overlay of one (index, name, fields) job. Return (latency,
+        name, error, overlay PDF, overlay pages) where the overlay PDF is
+        None if nothing was drawn.
+        """
+        _, name, form_data = job
+        start = default_timer()
+        error = overlay = None
+        overlay_pages = {}
+        try:
+            self.set_form_data(form_data)
+            self.load_base_form()
+            overlay, overlay_pages = self.render_overlay(self.plan)
+            if overlay is not None:
+                overlay = self.overlaybuf.getvalue()
+        except Exception as e:
+            error = "{}: {}".format(e.__class__.__name__, e)
+        return (default_timer() - start, name, error, overlay, overlay_pages)
+
+    def render(self, target=None):
+        """
+        Render text on PDF document. Write it to target, a file name or any
+        writable file-like object such as a pipe or socket file, or to the
+        output file if not given.
+        """
+        if target is None:
+            target = self.output_file
+        if self.result_cache is not None:
+            return self.render_cached(target)
+
+        self.build_output()
+        if isinstance(target, str):
+            self.write_to_file(target)
+        else:
+            self.write_output(target)
+        self.metrics.finish()
 
-        self.fields = [x for x in form_data]
-        if extra_data_file:
-            self.fields += extra_data
+    def build_output(self):
+        """
+        Draw the overlay and merge it onto the base form, or in direct mode
+        draw the fields into the page contents. When filling AcroForm
+        fields, the overlay only holds fields the form does not have and is
+        skipped altogether if there are none.
+        """
+        self.load_base_form()
+        plan = (self.fill_plan() if self.acroform or self.incremental
+                else self.plan)
+        self.final, self.overlay_pages = None, {}
+        if self.direct and not self.incremental and self.drawable(plan):
+            self.output = self.merge_content(*self.render_content(plan))
+        else:
+            if plan:
+                self.final, self.overlay_pages = self.render_overlay(plan)
+            # Incremental output is merged as it is written, see
+            # write_output().
+            self.output = None
+            if not self.incremental:
+                self.output = self.merge_overlay(self.final,
+                        self.overlay_pages)
+        if self.acroform:
+            self.fill_acroform(self.output, self.native)
+
+    def drawable(self, plan):
+        """
+        Whether every field of the plan can be drawn without reportlab:
+        lines, outlines, text in a standard 14 font and empty images.
+        """
+        for entries in plan.values():
+            for field, value in entries:
+                if field.kind == 'image' and value:
+                    return False
+                if field.kind == 'text' and \
+                        field.font_face not in STANDARD_FONTS:
+                    return False
+        return True
+
+    def render_content(self, plan):
+        """
+        Draw the fields of the plan straight to content streams with a
+        ContentCanvas. Return a map of base form page index to the content
+        drawn on it and a map of the fonts used to their resource names.
+        """
+        start = default_timer()
+        fonts = {}
+        content = {}
+        outside = []
+        for page_num in sorted(plan):
+            if page_num < 1 or page_num > self.pages:
+                outside.append(page_num)
+                continue
+            self.overlay = ContentCanvas(fonts)
+            for field, value in plan[page_num]:
+                self.render_field(field, value)
+            content[page_num - 1] = self.overlay.getvalue()
+        self.warn_outside(outside)
+        self.metrics.time('overlay', default_timer() - start)
+        return content, fonts
+
+    def merge_content(self, content, fonts):
+        """
+        Append the content drawn by render_content() to copies of the base
+        form pages, along with the fonts it uses. The base page content is
+        not parsed. Return the writer holding the document.
+        """
+        start = default_timer()
+        output = PdfFileWriter()
+        resources = dict((NameObject(name), font_resource(font_face))
+                for font_face, name in fonts.items())
+        for i in range(self.pages):
+            page = copy_page(self.form.getPage(i))
+            if i in content:
+                page_resources = DictionaryObject()
+                if '/Resources' in page:
+                    page_resources = copy_direct(page['/Resources'])
+                page_fonts = DictionaryObject(resources)
+                if '/Font' in page_resources:
+                    page_fonts.update(copy_direct(page_resources['/Font']))
+                page_resources[NameObject('/Font')] = page_fonts
+                page[NameObject('/Resources')] = page_resources
+                self.append_content(output, page, content[i])
+            output.addPage(page)
+
+        self.metrics.count('pages', self.pages)
+        self.metrics.count('pages_merged', len(content))
+        self.metrics.time('merge', default_timer() - start)
+        return output
+
+    def fill_plan(self):
+        """
+        The overlay plan when filling AcroForm fields or writing
+        incrementally. The base form is not stamped, so static fields are
+        drawn with the rest.
+        """
+        plan = dict((page, list(entries))
+                for page, entries in self.static_plan.items())
+        for page, entries in self.plan.items():
+            plan.setdefault(page, []).extend(entries)
+        return plan
 
-        self.fields.sort(key=lambda x: x['page'], reverse=False)
+    def render_cached(self, target):
+        """
+        Render through the result cache. On a hit the stored PDF is written
+        to target without rendering.
+        """
+        start = default_timer()
+        key = self.result_key()
+        pdf = self.result_cache.get(key)
+        self.cache_hit = pdf is not None
+        self.metrics.count('result_cache_hits' if self.cache_hit else
+                'result_cache_misses')
+        self.metrics.time('result_cache', default_timer() - start)
+        if pdf is None:
+            self.build_output()
+            filledbuf = CharIO()
+            self.write_output(filledbuf)
+            pdf = filledbuf.getvalue()
+            self.result_cache.put(key, pdf)
+
+        if isinstance(target, str):
+            with open(target, 'wb') as output_file:
+                output_file.write(pdf)
+        else:
+            target.write(pdf)
+        self.metrics.finish()
 
-    def render(self):
+    def result_key(self):
+        """
+        Hash of everything the filled form depends on: the base form bytes,
+        the template and extra data, the form data and the content of the
+        images it draws.
         """
-        Render text on PDF document.
+        if self.layout_key is None:
+            self.layout_key = json.dumps([RESULT_CACHE_VERSION,
+                    self.extra_data, self.template, bool(self.preview),
+                    self.acroform, self.flatten, self.incremental,
+                    self.direct], sort_keys=True)
+        digest = hashlib.sha256()
+        digest.update(self.form_cache.get(self.base_form).digest().encode(
+                'ascii'))
+        digest.update(self.layout_key.encode('utf-8'))
+        digest.update(json.dumps(self.form_data, sort_keys=True).encode(
+                'utf-8'))
+        for plan in (self.static_plan, self.plan):
+            for page_num in sorted(plan):
+                for field, value in plan[page_num]:
+                    if field.kind == 'image' and value:
+                        digest.update(self.image_cache.digest(value))
+        return digest.hexdigest()
+
+    def render_overlay(self, plan):
         """
-        with open(self.base_form, 'rb') as f:
-            self.docbuf = CharIO(f.read())
+        Draw the fields of the plan on an overlay with one page for each base
+        form page that has fields. Return the overlay read back for merging,
+        or None if nothing was drawn, and a map of base form page index to
+        overlay page index. Fields on pages the base form does not have are
+        reported with a warning.
+        """
+        start = default_timer()
         self.overlaybuf = CharIO()
-        self.filledbuf = CharIO()
-        self.form = PdfFileReader(self.docbuf, strict=False) #.getPage(0)
-        self.pages = self.form.getNumPages()
-        self.pagesize = self.form.getPage(0).mediaBox.upperRight
         self.overlay = canvas.Canvas(self.overlaybuf, pagesize=self.pagesize)
-        fields = [x for x in self.fields]
-
-        for page_num in range(1, self.pages+1):
-            for i, field in enumerate(fields):
-                # Do not consider fields that belong to subsequent pages.
-                if field['page'] > page_num or field['page'] < page_num:
-                    break
+        overlay_pages = {}
+        outside = []
 
-                # Render field on current canvas page.
-                self.render_field(field)
+        for page_num in sorted(plan):
+            if page_num < 1 or page_num > self.pages:
+                outside.append(page_num)
+                continue
 
-            # Remove fields that have already been placed on page.
-            fields = fields[i:]
+            # Render fields on current canvas page.
+            for field, value in plan[page_num]:
+                self.render_field(field, value)
 
-            # Next page
+            # Next page. Pages without fields get no overlay page.
+            overlay_pages[page_num - 1] = len(overlay_pages)
             self.overlay.showPage()
 
-        self.overlay.save()
-        self.overlaybuf.seek(0)
-        self.final = PdfFileReader(self.overlaybuf, strict=False)
-        self.output = PdfFileWriter()
+        self.warn_outside(outside)
+
+        overlay = None
+        if overlay_pages:
+            self.overlay.save()
+            self.overlaybuf.seek(0)
+            overlay = PdfFileReader(self.overlaybuf, strict=False)
+        self.metrics.time('overlay', default_timer() - start)
+        return overlay, overlay_pages
+
+    def warn_outside(self, outside):
+        """
+        Warn about fields on pages the base form does not have.
+        """
+        if outside:
+            warnings.warn("Fields on pages {} not drawn. {} has {} "
+                    "pages.".format(", ".join(str(x) for x in outside),
+                    self.base_form, self.pages), RenderWarning)
+
+    def merge_overlay(self, overlay, overlay_pages):
+        """
+        Merge overlay pages onto copies of the base form pages that have
+        fields. Other pages are added as they are, so their content streams
+        are copied to the output without being parsed. Return the writer
+        holding the merged document.
+        """
+        start = default_timer()
+        output = PdfFileWriter()
 
         # Merge text overlay pages onto original document pages.
         for i in range(self.pages):
-            page = self.form.getPage(i)
-            page.mergePage(self.final.getPage(i))
-            self.output.addPage(page)
+            page = copy_page(self.form.getPage(i))
+            if i in overlay_pages:
+                page.mergePage(overlay.getPage(overlay_pages[i]))
+            output.addPage(page)
+
+        self.metrics.count('pages', self.pages)
+        self.metrics.count('pages_merged', len(overlay_pages))
+        self.metrics.time('merge', default_timer() - start)
+        return output
+
+    def fill_acroform(self, output, values):
+        """
+        Fill the base form's AcroForm fields with values, a mapping of field
+        name to value, in the merged output. The field tree is copied into
+        the output and the copies replace the originals in the page
+        annotations, so the parsed base form is left untouched. Text and
+        choice fields get a new appearance stream and viewers are asked to
+        regenerate appearances. With flatten, every widget is drawn into its
+        page and the form is dropped.
+        """
+        start = default_timer()
+        acroform = self.form_cache.get(self.base_form).acroform()
+        if acroform.form is None:
+            return
+        copies = dict(((ref.idnum, ref.generation),
+                output._addObject(copy_direct(ref.getObject())))
+                for ref in acroform.nodes)
+
+        def copied(ref):
+            if not isinstance(ref, IndirectObject):
+                return ref
+            return copies.get((ref.idnum, ref.generation), ref)
+
+        for ref in copies.values():
+            node = ref.getObject()
+            if '/Parent' in node:
+                node[NameObject('/Parent')] = copied(node.raw_get('/Parent'))
+            if '/Kids' in node:
+                node[NameObject('/Kids')] = ArrayObject(
+                        copied(x) for x in node['/Kids'])
+
+        for name, value in values.items():
+            field = acroform.fields[name]
+            self.fill_field(output, acroform, field,
+                    copied(field.ref).getObject(),
+                    [copied(x).getObject() for x in field.widgets], value)
+        self.metrics.count('fields_filled', len(values))
+
+        for i in range(self.pages):
+            page = output.getPage(i)
+            if '/Annots' not in page:
+                continue
+            annots = ArrayObject(copied(x) for x in page['/Annots'])
+            if self.flatten:
+                annots = self.flatten_widgets(output, page, annots)
+            if annots:
+                page[NameObject('/Annots')] = annots
+            else:
+                del page['/Annots']
+
+        if not self.flatten:
+            form = copy_direct(acroform.form)
+            form[NameObject('/Fields')] = ArrayObject(
+                    copied(x) for x in acroform.form['/Fields'])
+            form[NameObject('/NeedAppearances')] = BooleanObject(True)
+            output._root_object[NameObject('/AcroForm')] = \
+                    output._addObject(form)
+        self.metrics.time('acroform', default_timer() - start)
+
+    def fill_field(self, output, acroform, field, node, widgets, value):
+        """
+        Set the value of one field. node is the output's copy of the field
+        dictionary and widgets the copies of its widget annotations.
+        """
+        kind = field.attributes.get('/FT')
+        if kind == '/Btn':
+            state = self.button_state(field, widgets, value)
+            node[NameObject('/V')] = NameObject(state)
+            for widget in widgets:
+                widget[NameObject('/AS')] = NameObject(state
+                        if state in self.button_states(widget) else '/Off')
+        elif kind in ('/Tx', '/Ch'):
+            text = '' if value is None else '{}'.format(value)
+            node[NameObject('/V')] = TextStringObject(text)
+            for widget in widgets:
+                widget[NameObject('/AP')] = DictionaryObject({
+                        NameObject('/N'): output._addObject(
+                        self.text_appearance(acroform, field, widget, text))})
+        else:
+            warnings.warn("AcroForm field '{}' of type {} not filled.".format(
+                    field.name, kind), RenderWarning)
 
-        # Write to buffer and write to file.
-        self.output.write(self.filledbuf)
-        self.write_to_file(self.output_file)
+    def button_states(self, widget):
+        """
+        The 'on' appearance states of a check box or radio button widget.
+        """
+        if '/AP' not in widget or '/N' not in widget['/AP']:
+            return []
+        appearance = widget['/AP']['/N']
+        if isinstance(appearance, StreamObject):
+            return []
+        return [x for x in appearance if x != '/Off']
+
+    def button_state(self, field, widgets, value):
+        """
+        The appearance state for a button value. True checks the box, false
+        or empty values clear it and other values name the state to select.
+        """
+        states = [x for widget in widgets for x in self.button_states(widget)]
+        if value is True:
+            return states[0] if states else '/Yes'
+        if value in (False, None, '', 'Off'):
+            return '/Off'
+        state = '/{}'.format(value)
+        if state not in states:
+            warnings.warn("AcroForm field '{}' has no state {}. Options are "
+                    "{}.".format(field.name, value, ", ".join(
+                    x[1:] for x in states)), RenderWarning)
+            return '/Off'
+        return state
+
+    def text_appearance(self, acroform, field, widget, text):
+        """
+        Appearance stream showing text in a text or choice widget, using the
+        widget's default appearance font, size and color. A font size of 0
+        fits the text to the widget. Multiline fields wrap the text.
+        """
+        rect = [float(x) for x in widget['/Rect']]
+        width = abs(rect[2] - rect[0])
+        height = abs(rect[3] - rect[1])
+        inner = width - 2 * WIDGET_PADDING
+        multiline = int(acroform.value(field, widget, '/Ff', 0)) & (1 << 12)
+        appearance = acroform.value(field, widget, '/DA', WIDGET_DA)
+        match = re.search(r'/(\S+)\s+([\d.]+)\s+Tf', appearance)
+        font_name, size = ('Helv', 0) if match is None else (match.group(1),
+                float(match.group(2)))
+
+        font = None
+        if '/DR' in acroform.form and '/Font' in acroform.form['/DR']:
+            font = acroform.form['/DR']['/Font'].raw_get('/' + font_name)
+        face = 'Helvetica'
+        if font is None:
+            font = DictionaryObject({
+                    NameObject('/Type'): NameObject('/Font'),
+                    NameObject('/Subtype'): NameObject('/Type1'),
+                    NameObject('/BaseFont'): NameObject('/Helvetica'),
+                    NameObject('/Encoding'): NameObject('/WinAnsiEncoding')})
+        elif font.getObject().get('/BaseFont', '/')[1:] in \
+                pdfmetrics.standardFonts:
+            face = font.getObject()['/BaseFont'][1:]
+        metrics = font_metrics(face)
+
+        if not size:
+            size = WIDGET_FONT_SIZE
+            if not multiline:
+                size = min(size, (height - 2 * WIDGET_PADDING) / LEADING)
+                text_width = metrics.string_width(text, size)
+                if text_width > inner:
+                    size = size * inner / text_width
+            size = max(size, MIN_FONT_SIZE)
+        if multiline:
+            max_lines = max(int((height - 2 * WIDGET_PADDING) /
+                    (size * LEADING)), 1)
+            fit = lambda text, max_width: metrics.fit_prefix(text, max_width,
+                    size)
+            lines = []
+            for paragraph in text.split('\n'):
+                lines.extend(wrap_text(paragraph, inner,
+                        max_lines - len(lines), fit) or [''])
+            lines = lines[:max_lines]
+            y = height - WIDGET_PADDING - metrics.ascent * size
+        else:
+            lines = [text]
+            y = (height - size) / 2 + (1 - metrics.ascent) * size
+
+        quadding = int(acroform.value(field, widget, '/Q', 0))
+        appearance = re.sub(r'[\d.]+(\s+Tf)', '{:.2f}'.format(size) + r'\1',
+                appearance, count=1)
+        mk = widget['/MK'] if '/MK' in widget else {}
+        ops = [b'/Tx BMC', b'q']
+        if mk.get('/BG'):
+            ops.append('{} 0 0 {:.3f} {:.3f} re f'.format(
+                    color_operator(mk['/BG']), width, height).encode('ascii'))
+        if mk.get('/BC'):
+            border = 1.0
+            if '/BS' in widget:
+                border = float(widget['/BS'].get('/W', 1))
+            ops.append('{} {:.3f} w {:.3f} {:.3f} {:.3f} {:.3f} re S'.format(
+                    color_operator(mk['/BC'], True), border, border / 2,
+                    border / 2, width - border, height - border).encode(
+                    'ascii'))
+        ops.append('{0} {0} {1:.3f} {2:.3f} re W n BT {3}'.format(
+                WIDGET_PADDING / 2.0, width - WIDGET_PADDING,
+                height - WIDGET_PADDING, appearance).encode('latin-1'))
+        for line in lines:
+            x = WIDGET_PADDING
+            if quadding == 1:
+                x = (width - metrics.string_width(line, size)) / 2
+            elif quadding == 2:
+                x = inner + WIDGET_PADDING - metrics.string_width(line, size)
+            ops.append('1 0 0 1 {:.3f} {:.3f} Tm '.format(x, y).encode(
+                    'ascii') + pdf_string(line) + b' Tj')
+            y -= size * LEADING
+        ops.extend([b'ET', b'Q', b'EMC'])
+
+        stream = DecodedStreamObject()
+        stream.setData(b'\n'.join(ops))
+        stream.update({
+                NameObject('/Type'): NameObject('/XObject'),
+                NameObject('/Subtype'): NameObject('/Form'),
+                NameObject('/BBox'): ArrayObject([NumberObject(0),
+                        NumberObject(0), FloatObject(width),
+                        FloatObject(height)]),
+                NameObject('/Resources'): DictionaryObject({
+                        NameObject('/Font'): DictionaryObject({
+                        NameObject('/' + font_name): font})})})
+        return stream
+
+    def flatten_widgets(self, output, page, annots):
+        """
+        Draw the normal appearance of each visible widget annotation into the
+        page's content. Return the page's other annotations.
+        """
+        kept = ArrayObject()
+        xobjects = DictionaryObject()
+        ops = []
+        for ref in annots:
+            annot = ref.getObject()
+            if annot.get('/Subtype') != '/Widget':
+                kept.append(ref)
+                continue
+            appearance = None
+            if '/AP' in annot and '/N' in annot['/AP']:
+                appearance = annot['/AP'].raw_get('/N')
+            # Buttons have one appearance per state.
+            states = appearance and appearance.getObject()
+            if isinstance(states, DictionaryObject) and not isinstance(
+                    states, StreamObject):
+                appearance = None
+                if annot.get('/AS') in states:
+                    appearance = states.raw_get(annot['/AS'])
+            # Hidden widgets (annotation flag 2) are not drawn.
+            if appearance is None or int(annot.get('/F', 0)) & 2:
+                continue
+            if not isinstance(appearance, IndirectObject):
+                appearance = output._addObject(appearance)
+
+            name = WIDGET_NAME.format(len(xobjects))
+            xobjects[NameObject(name)] = appearance
+            rect = [float(x) for x in annot['/Rect']]
+            bbox = [float(x) for x in appearance.getObject()['/BBox']]
+            scale_x = scale_y = 1.0
+            if bbox[2] != bbox[0] and bbox[3] != bbox[1]:
+                scale_x = abs(rect[2] - rect[0]) / abs(bbox[2] - bbox[0])
+                scale_y = abs(rect[3] - rect[1]) / abs(bbox[3] - bbox[1])
+            ops.append('q {:.4f} 0 0 {:.4f} {:.3f} {:.3f} cm {} Do Q'.format(
+                    scale_x, scale_y,
+                    min(rect[0], rect[2]) - min(bbox[0], bbox[2]) * scale_x,
+                    min(rect[1], rect[3]) - min(bbox[1], bbox[3]) * scale_y,
+                    name))
+        if not ops:
+            return kept
+
+        resources = DictionaryObject()
+        if '/Resources' in page:
+            resources = copy_direct(page['/Resources'])
+        if '/XObject' in resources:
+            xobjects.update(copy_direct(resources['/XObject']))
+        resources[NameObject('/XObject')] = xobjects
+        page[NameObject('/Resources')] = resources
+        self.append_content(output, page, '\n'.join(ops).encode('ascii'))
+        self.metrics.count('widgets_flattened', len(ops))
+        return kept
+
+    def append_content(self, output, page, data):
+        """
+        Draw a content stream over a page of the output. The page's own
+        content is wrapped in q and Q so it cannot change how data is drawn.
+        """
+        contents = page.raw_get('/Contents') if '/Contents' in page else []
+        if isinstance(contents, IndirectObject):
+            resolved = contents.getObject()
+            if isinstance(resolved, ArrayObject):
+                contents = resolved
+        if isinstance(contents, StreamObject):
+            contents = output._addObject(contents)
+        if not isinstance(contents, list):
+            contents = [contents]
+        before = DecodedStreamObject()
+        before.setData(b'q\n')
+        after = DecodedStreamObject()
+        after.setData(b'\nQ\n' + data + b'\n')
+        page[NameObject('/Contents')] = ArrayObject([output._addObject(before)]
+                + list(contents) + [output._addObject(after)])
 
     def write_to_file(self, filename):
         """
         Write the completed PDF to file.
         """
         # XXX No error checkinng on the write...
-        output_file = open(filename, 'wb')
-        output_file.write(self.filledbuf.getvalue())
-        output_file.close()
+        with open(filename, 'wb') as output_file:
+            self.write_output(output_file)
 
-    def render_field(self, field):
+    def write_output(self, target):
         """
-        Render text or image field.
+        Stream the completed PDF straight to a writable file-like object.
+        Incremental output is the base form followed by the overlay pages,
+        see IncrementalWriter.
         """
+        start = default_timer()
+        stream = OutputStream(target)
+        if self.incremental:
+            writer = IncrementalWriter(stream, self.form, self.base.data())
+            for i, page_num in sorted(self.overlay_pages.items()):
+                writer.add_page(self.form.getPage(i),
+                        self.final.getPage(page_num))
+            writer.close()
+            self.metrics.count('pages_merged', len(self.overlay_pages))
+        else:
+            self.output.write(stream)
+        self.metrics.count('bytes_written', stream.tell())
+        self.metrics.time('write', default_timer() - start)
+
+    def render_field(self, field, value):
+        """
+        Render a compiled field with its value.
+        """
+        start = default_timer()
         if self.preview:
             self.render_preview_box(field)
-        if (field.get('type', 'text') == "image"):
-            draw_point = self.calculate_image_draw_point(field)
-            draw_fnct = self.render_image
-        if (field.get('type', 'text') == "text"):
-            draw_point = self.calculate_text_draw_point(field)
-            draw_fnct = self.render_text
-        if (field.get('type', 'text') == "outline"):
-            draw_point = self.calculate_image_draw_point(field)
-            draw_fnct = self.render_outline
-        if (field.get('type', 'text') == "line"):
-            draw_point = self.calculate_image_draw_point(field)
-            draw_fnct = self.render_line
-        draw_fnct(field, draw_point)
-
-    def render_line(self, field, draw_point):
+        field.draw(self, field, value)
+        self.metrics.time(field.kind, default_timer() - start)
+
+    def render_line(self, field, value):
         """
-        Render outline rectangle with hard-wired radius.
+        Render line from the field origin to the opposite corner.
         """
         c = self.overlay    # Canvas
 
-        x, y = draw_point
-        _, _, width, height = self.get_position_and_size(field)
-        x2 = x + width
-        y2 = y + height
+        x, y = field.draw_point
+        _, _, width, height = field.position
 
         c.saveState()
         c.translate(x, y)
 
-        if 'rotation' in field:
-            c.rotate(int(field['rotation']))
+        if field.rotation is not None:
+            c.rotate(field.rotation)
 
-        if 'line_width' in field:
-            c.setLineWidth(int(field['line_width']))
+        if field.line_width is not None:
+            c.setLineWidth(field.line_width)
 
-        (r, g, b) = self.calculate_rgb_values(field)
-        c.setStrokeColorRGB(r, g, b)
+        c.setStrokeColorRGB(*field.rgb)
 
         c.line(0, 0, width, height)
         c.restoreState()
 
-    def render_outline(self, field, draw_point):
+    def render_outline(self, field, value):
         """
         Render outline rectangle with hard-wired radius.
         """
         c = self.overlay    # Canvas
 
-        x, y = draw_point
-        _, _, width, height = self.get_position_and_size(field)
+        x, y = field.draw_point
+        _, _, width, height = field.position
         radius = 5          # Hard-wired radius.
 
         c.saveState()
         c.translate(x, y)
 
-        if 'rotation' in field:
-            c.rotate(int(field['rotation']))
+        if field.rotation is not None:
+            c.rotate(field.rotation)
 
-        if 'line_width' in field:
-            c.setLineWidth(int(field['line_width']))
+        if field.line_width is not None:
+            c.setLineWidth(field.line_width)
 
-        (r, g, b) = self.calculate_rgb_values(field)
-        c.setStrokeColorRGB(r, g, b)
+        c.setStrokeColorRGB(*field.rgb)
 
         c.roundRect(0, 0, width, height, radius, stroke=True, fill=False)
         c.restoreState()
 
-    def render_image(self, field, draw_point):
+    def render_image(self, field, value):
         """
-        Render image field.
+        Render image field. The value is the path to the image.
         """
         c = self.overlay    # Canvas
 
-        x, y = draw_point
-        _, _, width, height = self.get_position_and_size(field)
+        x, y = field.draw_point
+        _, _, width, height = field.position
 
         # TODO: validate file?
-        img_file = field['data']
+        if not value:
+            return
+        start = default_timer()
+        image = self.image_cache.get(value)
+        self.metrics.time('image_load', default_timer() - start)
         c.saveState()
         c.translate(x, y)
-        if 'rotation' in field:
-            c.rotate(int(field['rotation']))
-        c.drawImage(img_file, 0, 0, width, height, preserveAspectRatio=True)
+        if field.rotation is not None:
+            c.rotate(field.rotation)
+        self.draw_image(image, width, height)
         c.restoreState()
 
-    def render_text(self, field, draw_point):
+    def draw_image(self, image, width, height):
         """
-        Resolve the field value and draw left, right, or center.
+        Draw a cached image centered in a width by height box at the origin,
+        preserving its aspect ratio. This is canvas.drawImage() without
+        loading the image. The image is embedded once per document however
+        many fields use it.
         """
         c = self.overlay    # Canvas
 
-        x, y = draw_point
+        reg_name = c._doc.getXObjectName(image.name)
+        if reg_name not in c._doc.idToObject:
+            # Register a copy. reportlab marks registered objects as owned
+            # by the document.
+            xobject = copy.copy(image.xobject)
+            c._setXObjects(xobject)
+            c._doc.Reference(xobject, reg_name)
+            c._doc.addForm(image.name, xobject)
 
-        # Support 'data' and 'text' attributes. Preference for 'data'.
-        if 'data' in field:
-            field_value = field['data']
-        else:
-            field_value = field['text']
-
-        # Shrink text by 1 character until it fits.
-        # XXX: Danger, this will result if a single char won't fit.
-        while (pdfmetrics.stringWidth(field_value, field['font_face'],
-                field['font_size']) > float(field['width'])):
-            if (len(field_value) > 1):
-                field_value = field_value[:len(field_value)-1]
-            if (len(field_value) == 1):
-                raise Exception("Single character won't fit. You should "
-                        "fix that. Stubbornly refusing to continue")
+        scale = min(width / image.width, height / image.height)
+        draw_width = image.width * scale
+        draw_height = image.height * scale
+
+        c._currentPageHasImages = 1
+        c.saveState()
+        c.translate((width - draw_width) / 2, (height - draw_height) / 2)
+        c.scale(draw_width, draw_height)
+        c._code.append("/{} Do".format(reg_name))
+        c.restoreState()
+        c._formsinuse.append(image.name)
+
+    def render_text(self, field, value):
+        """
+        Draw the field value left, right, or center. None draws nothing.
+        """
+        c = self.overlay    # Canvas
+
+        x, y = field.draw_point
+        start = default_timer()
+        text = "" if value is None else "{}".format(value)
+        lines, font_size = self.fit_text(field, text)
+        self.metrics.time('fit_text', default_timer() - start)
 
         c.saveState()
+        c.setFont(field.font_face, font_size)
         c.translate(x, y)
 
-        if 'rotation' in field:
-            c.rotate(int(field['rotation']))
+        if field.rotation is not None:
+            c.rotate(field.rotation)
 
-        (r, g, b) = self.calculate_rgb_values(field)
-        c.setFillColorRGB(r, g, b)
+        c.setFillColorRGB(*field.rgb)
 
-        if field['align_horizontal'] == LEFT:
-            c.drawString(0, 0, "{}".format(field_value))
+        # The draw point centers one line at the field font size. Keep a
+        # smaller font or several lines centered too.
+        leading = font_size * LEADING
+        offset = field.ascent * (field.font_size - font_size) / 2
+        offset += (len(lines) - 1) * leading / 2
 
-        if field['align_horizontal'] == RIGHT:
-            c.drawRightString(0, 0, "{}".format(field_value))
+        for line in lines:
+            if field.align == LEFT:
+                c.drawString(0, offset, line)
 
-        if field['align_horizontal'] == CENTER:
-            c.drawCentredString(0, 0, "{}".format(field_value))
+            if field.align == RIGHT:
+                c.drawRightString(0, offset, line)
+
+            if field.align == CENTER:
+                c.drawCentredString(0, offset, line)
+
+            offset -= leading
 
         c.restoreState()
 
+    def fit_text(self, field, value):
+        """
+        Fit the value within the field width using the field's fit strategy.
+        Return the lines to draw and the font size to draw them at.
+        """
+        metrics = field.metrics
+        font_size = field.font_size
+        max_width = field.position[2]
+
+        def measure(text):
+            return metrics.string_width(text, font_size)
+
+        def fit(text, width):
+            return metrics.fit_prefix(text, width, font_size)
+
+        if field.fit == WRAP:
+            max_lines = max(1, int(field.position[3] // (font_size * LEADING)))
+            return wrap_text(value, max_width, max_lines, fit), font_size
+
+        if field.fit == SHRINK:
+            width = measure(value)
+            if width > max_width:
+                font_size = max(field.min_font_size,
+                        font_size * max_width / width)
+
+        end = fit(value, max_width)
+        if end == len(value):
+            return [value], font_size
+
+        if field.fit == ELLIPSIS:
+            # Too narrow for any text with the ellipsis: truncate instead.
+            shortened = fit(value, max_width - measure(ELLIPSIS_TEXT))
+            if shortened > 0:
+                return [value[:shortened].rstrip() + ELLIPSIS_TEXT], font_size
+
+        if end == 0:
+            raise Exception("Single character won't fit. You should "
+                    "fix that. Stubbornly refusing to continue")
+        return [value[:end]], font_size
+
     def render_preview_box(self, field):
         """
         Render the preview box.
@@ -238,7 +2808,7 @@ class FormRenderer(object):
         c = self.overlay    # Canvas
 
         # (x, y), field width, field height
-        x, y, width, height = self.get_position_and_size(field)
+        x, y, width, height = field.position
 
         red, green, blue = PREVIEW_COLOR
         red = float(red) / 255
@@ -250,11 +2820,79 @@ class FormRenderer(object):
         c.setFillColorRGB(red, green, blue)
         c.setStrokeColorRGB(0, 0, 0)
         c.setLineWidth(0.5)
-        if 'rotation' in field:
-            c.rotate(int(field['rotation']))
+        if field.rotation is not None:
+            c.rotate(field.rotation)
         c.rect(0, 0, width, height, fill=1)
         c.restoreState()
 
+    def compile_field(self, field):
+        """
+        Resolve everything about a field that does not depend on its value.
+        Fields with identical layout share one CompiledField.
+        """
+        key = tuple(sorted((k, v) for k, v in field.items()
+                if k not in VALUE_KEYS))
+        compiled = self.compiled.get(key)
+        if compiled is not None:
+            return compiled
+
+        kind = field.get('type', 'text')
+        if kind not in FIELD_TYPES:
+            raise Exception("{} has unknown type {}.".format(
+                    describe_field(field), kind))
+        compiled = FIELD_TYPES[kind]()
+        missing = [x for x in compiled.required if x not in field]
+        if missing:
+            raise Exception("{} is missing {}.".format(describe_field(field),
+                    ", ".join(missing)))
+        try:
+            self.resolve_field(compiled, field)
+        except (TypeError, ValueError) as e:
+            raise Exception("{} is invalid: {}".format(describe_field(field),
+                    e))
+
+        if len(self.compiled) >= COMPILED_FIELDS_MAX:
+            self.compiled.clear()
+        self.compiled[key] = compiled
+        return compiled
+
+    def resolve_field(self, compiled, field):
+        """
+        Convert and check the attributes of a field dict once, storing them
+        on its compiled field.
+        """
+        compiled.page = int(field['page'])
+        compiled.position = self.get_position_and_size(field)
+        compiled.rotation = None
+        if 'rotation' in field:
+            compiled.rotation = int(field['rotation'])
+        compiled.line_width = None
+        if 'line_width' in field:
+            compiled.line_width = int(field['line_width'])
+        compiled.rgb = self.calculate_rgb_values(field)
+        compiled.draw = DRAW_FUNCTIONS[compiled.kind]
+
+        if compiled.kind != 'text':
+            compiled.draw_point = self.calculate_image_draw_point(field)
+            return
+
+        compiled.font_face = field['font_face']
+        compiled.font_size = int(field['font_size'])
+        try:
+            compiled.metrics = font_metrics(compiled.font_face)
+        except KeyError:
+            raise ValueError("unknown font {}".format(compiled.font_face))
+        compiled.ascent = compiled.metrics.ascent
+        compiled.align = field['align_horizontal']
+        if compiled.align not in (LEFT, RIGHT, CENTER):
+            raise ValueError("unknown alignment {}".format(compiled.align))
+        compiled.fit = field.get('fit', TRUNCATE)
+        if compiled.fit not in FIT_STRATEGIES:
+            raise ValueError("unknown fit {}".format(compiled.fit))
+        compiled.min_font_size = float(
+                field.get('min_font_size', MIN_FONT_SIZE))
+        compiled.draw_point = self.calculate_text_draw_point(field)
+
     def get_position_and_size(self, field):
         """
         Extract position, field width, and field height. Return as tuple.
@@ -277,17 +2915,13 @@ class FormRenderer(object):
         """
         Calculate correct coordinates to draw text.
         """
-        c = self.overlay    # Canvas
-
         x = float(field['x'])
         y = float(field['y'])
 
         field_height = float(field['height'])
         # Always vertically center text within field.
-        c.setFont(field['font_face'], int(field['font_size']))
-        font_face = pdfmetrics.getFont(field['font_face']).face
         font_size = float(field['font_size'])
-        ascent = (font_face.ascent * font_size) / 1000.0
+        ascent = font_metrics(field['font_face']).ascent * font_size
         voffset = (field_height - ascent) / 2
 
         # Radians
@@ -328,6 +2962,622 @@ class FormRenderer(object):
         return (r, g, b,)
 
 
+DRAW_FUNCTIONS = {
+    'text': FormRenderer.render_text,
+    'image': FormRenderer.render_image,
+    'outline': FormRenderer.render_outline,
+    'line': FormRenderer.render_line,
+}
+
+
+# Renderer owned by each batch worker process. See render_batch().
+_worker_renderer = None
+
+
+def _init_worker(base_form, extra_data, template, preview,
+        result_cache=None, acroform=False, flatten=False,
+        incremental=False, direct=False, bundle_file=None, stamped=None):
+    """
+    Batch worker initializer. Parse the base form and compile the template
+    once per process, or load both from bundle_file. result_cache is the
+    (directory, max_bytes) of a shared ResultCache, if any. stamped is the
+    file and key from write_stamped_form(), if any. If that fails the error
+    is kept so the worker still starts, see _render_jobs(); an exception
+    here would make the pool start workers forever.
+    """
+    global _worker_renderer
+    try:
+        if result_cache is not None:
+            result_cache = ResultCache(*result_cache)
+        renderer = FormRenderer(base_form, None, None, preview=preview,
+                result_cache=result_cache, acroform=acroform,
+                flatten=flatten, incremental=incremental, direct=direct,
+                bundle_file=bundle_file)
+        if bundle_file is None:
+            renderer.set_extra_data(extra_data)
+            if template is not None:
+                renderer.load_template(template)
+        if stamped is not None:
+            renderer.set_stamped_form(*stamped)
+        renderer.load_base_form()
+    except Exception as e:
+        renderer = "{}: {}".format(e.__class__.__name__, e)
+    _worker_renderer = renderer
+
+
+def _render_jobs(method, jobs):
+    """
+    Run a chunk of batch jobs with the named FormRenderer method in a worker
+    process. If the worker failed to start, every job fails with its error.
+    """
+    if isinstance(_worker_renderer, FormRenderer):
+        return [getattr(_worker_renderer, method)(job) for job in jobs]
+    failed = {'render_job': (False,), 'overlay_job': (None, {})}[method]
+    return [(0, job[1], _worker_renderer) + failed for job in jobs]
+
+
+# FormRenderers by (base form, extra data, template, preview) for the
+# executor thread or process running _async_render().
+_async_renderers = threading.local()
+
+
+def _async_render(config, form_data):
+    """
+    Render form data in an executor. Each thread or process keeps its own
+    renderer, with its own parsed base form, for each configuration. Return
+    the filled PDF.
+    """
+    renderers = _async_renderers.__dict__
+    renderer = renderers.get(config)
+    if renderer is None:
+        base_form, extra_data_file, template_file, preview = config
+        renderer = renderers[config] = FormRenderer(base_form, None, None,
+                extra_data_file, preview, form_cache=BaseFormCache(),
+                template_file=template_file)
+    renderer.set_form_data(form_data)
+    pdfbuf = CharIO()
+    renderer.render(pdfbuf)
+    return pdfbuf.getvalue()
+
+
+def _write_file(filename, pdf):
+    """
+    Write a filled PDF to a file.
+    """
+    with open(filename, 'wb') as output_file:
+        output_file.write(pdf)
+
+
+class AsyncRenderer(object):
+    """
+    Render forms from an asyncio event loop. Drawing and merging run on an
+    executor, a process pool by default, and output files are written on the
+    loop's default executor, so the loop is never blocked. At most
+    max_in_flight renders are queued, running or being written at once;
+    further callers wait their turn.
+    """
+
+    def __init__(self, base_form, extra_data_file=None, template_file=None,
+            preview=None, executor=None, max_in_flight=ASYNC_MAX_IN_FLIGHT):
+        self.config = (base_form, extra_data_file, template_file, preview)
+        self.own_executor = executor is None
+        self.executor = executor or ProcessPoolExecutor()
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.semaphore = None
+
+    async def render_async(self, form_data, target=None):
+        """
+        Render form data, a list of fields or a mapping of field name to
+        value for the template. Write it to target, a file name, a writable
+        file-like object or an asyncio StreamWriter, if given. Return the
+        filled PDF.
+        """
+        loop = asyncio.get_running_loop()
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        # Writing counts as in flight too, so slow targets hold back new
+        # renders rather than let filled PDFs pile up in memory.
+        async with self.semaphore:
+            self.in_flight += 1
+            try:
+                pdf = await loop.run_in_executor(self.executor, _async_render,
+                        self.config, form_data)
+                if isinstance(target, str):
+                    await loop.run_in_executor(None, _write_file, target, pdf)
+                elif hasattr(target, 'drain'):
+                    target.write(pdf)
+                    await target.drain()
+                elif target is not None:
+                    await loop.run_in_executor(None, target.write, pdf)
+            finally:
+                self.in_flight -= 1
+        return pdf
+
+    def close(self):
+        """
+        Shut down the executor if this renderer created it.
+        """
+        if self.own_executor:
+            self.executor.shutdown()
+
+
+def load_templates(path):
+    """
+    Read a templates file. It is a JSON object of template id to an object
+    with `base_form' and optional `template', `extra_data' and `preview'.
+    Relative paths are relative to the templates file.
+    """
+    with open(path) as f:
+        templates = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    for spec in templates.values():
+        for key in ('base_form', 'template', 'extra_data'):
+            if spec.get(key):
+                spec[key] = os.path.join(base_dir, spec[key])
+    return templates
+
+
+# Renderers owned by each render service worker process, by template id.
+_service_renderers = {}
+
+
+def load_service_template(spec, result_cache=None, stamped=None):
+    """
+    Return a FormRenderer for a templates file entry with its template
+    compiled and base form loaded. stamped is the file and key from
+    write_stamped_form(), if any.
+    """
+    renderer = FormRenderer(spec['base_form'], None, None,
+            spec.get('extra_data'), spec.get('preview'),
+            template_file=spec.get('template'), result_cache=result_cache)
+    if stamped is not None:
+        renderer.set_stamped_form(*stamped)
+    renderer.load_base_form()
+    return renderer
+
+
+def _init_service_worker(templates, result_cache=None, stamped=None):
+    """
+    Render service worker initializer. Load every template and base form
+    once so requests only pay for drawing. Repeated requests are served
+    from the result cache directory, if given. stamped maps template ids
+    to the stamped form files written by the service. A template that
+    fails to load is kept as its error so the worker still starts, see
+    _service_render().
+    """
+    if result_cache is not None:
+        result_cache = ResultCache(result_cache)
+    stamped = stamped or {}
+    for template_id, spec in templates.items():
+        try:
+            _service_renderers[template_id] = load_service_template(spec,
+                    result_cache, stamped.get(template_id))
+        except Exception as e:
+            _service_renderers[template_id] = "{}: {}".format(
+                    e.__class__.__name__, e)
+
+
+def _service_render(template_id, form_data):
+    """
+    Render form data with a template in a worker process. Return (pdf,
+    error) where error is None on success.
+    """
+    renderer = _service_renderers[template_id]
+    if not isinstance(renderer, FormRenderer):
+        return None, "Template {} failed to load: {}".format(template_id,
+                renderer)
+    filledbuf = CharIO()
+    try:
+        renderer.set_form_data(form_data)
+        renderer.render(filledbuf)
+    except Exception as e:
+        return None, "{}: {}".format(e.__class__.__name__, e)
+    return filledbuf.getvalue(), None
+
+
+class RenderService(object):
+    """
+    Render forms for a set of templates on a pool of worker processes. Each
+    worker keeps every template, base form, font and image warm. Every
+    template is loaded once up front, so a bad one fails here rather than
+    in the workers, and its stamped base form is written to a file the
+    workers share.
+    """
+
+    def __init__(self, templates, workers=None, result_cache=None):
+        self.stamp_dir = tempfile.mkdtemp(prefix='filler-')
+        stamped = {}
+        for template_id, spec in templates.items():
+            try:
+                stamped[template_id] = load_service_template(
+                        spec).write_stamped_form(self.stamp_dir)
+            except Exception as e:
+                shutil.rmtree(self.stamp_dir, ignore_errors=True)
+                raise Exception("Template {} failed to load: {}: {}".format(
+                        template_id, e.__class__.__name__, e))
+        self.templates = templates
+        self.pool = multiprocessing.Pool(workers, _init_service_worker,
+                (templates, result_cache, stamped))
+
+    def render(self, template_id, form_data):
+        """
+        Render form data, a field name to value mapping or list of fields,
+        with a template. Return the filled PDF.
+        """
+        if template_id not in self.templates:
+            raise KeyError(template_id)
+        pdf, error = self.pool.apply(_service_render, (template_id, form_data))
+        if error:
+            raise Exception(error)
+        return pdf
+
+    def close(self):
+        """
+        Stop the worker processes.
+        """
+        self.pool.close()
+        self.pool.join()
+        shutil.rmtree(self.stamp_dir, ignore_errors=True)
+
+
+# The classes returned by server_classes(), once defined.
+_server_classes = None
+
+
+def server_classes():
+    """
+    The render request handler and the TCP and Unix domain socket server
+    classes, defined on first use so that only the serve subcommand imports
+    http.server.
+    """
+    global _server_classes
+    if _server_classes is None:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn, UnixStreamServer
+
+        class RenderRequestHandler(BaseHTTPRequestHandler):
+            """
+            GET /templates lists the template ids. POST /render/<template
+            id> with a JSON body of form data responds with the filled PDF.
+            """
+
+            def do_GET(self):
+                """
+                List the template ids.
+                """
+                if self.path != '/templates':
+                    return self.send_text(404, "Not found.")
+                templates = sorted(self.server.service.templates)
+                body = json.dumps(templates).encode('utf-8')
+                self.send_body(200, 'application/json', body)
+
+            def do_POST(self):
+                """
+                Render the JSON body with the template named in the path.
+                """
+                template_id = self.path[len(RENDER_PATH):]
+                if (not self.path.startswith(RENDER_PATH) or
+                        template_id not in self.server.service.templates):
+                    return self.send_text(404, "Unknown template.")
+
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    form_data = json.loads(self.rfile.read(length).decode(
+                            'utf-8'))
+                except ValueError as e:
+                    return self.send_text(400, "Invalid JSON: {}".format(e))
+
+                try:
+                    pdf = self.server.service.render(template_id, form_data)
+                except Exception as e:
+                    return self.send_text(500, "{}".format(e))
+                self.send_body(200, 'application/pdf', pdf)
+
+            def send_text(self, code, message):
+                """
+                Send a plain text response.
+                """
+                self.send_body(code, 'text/plain; charset=utf-8',
+                        "{}\n".format(message).encode('utf-8'))
+
+            def send_body(self, code, content_type, body):
+                """
+                Send a complete response.
+                """
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def address_string(self):
+                """
+                Unix domain socket clients have no address.
+                """
+                if isinstance(self.client_address, tuple):
+                    return self.client_address[0]
+                return 'unix'
+
+            def log_message(self, format, *args):
+                """
+                Log requests to stderr unless the server is quiet.
+                """
+                if not self.server.quiet:
+                    BaseHTTPRequestHandler.log_message(self, format, *args)
+
+        class RenderHTTPServer(ThreadingMixIn, HTTPServer):
+            """
+            Threaded HTTP render server on a TCP port.
+            """
+            daemon_threads = True
+            quiet = False
+
+        class RenderUnixServer(ThreadingMixIn, UnixStreamServer):
+            """
+            Threaded HTTP render server on a Unix domain socket.
+            """
+            daemon_threads = True
+            quiet = False
+
+        _server_classes = (RenderRequestHandler, RenderHTTPServer,
+                RenderUnixServer)
+    return _server_classes
+
+
+def make_server(service, host='127.0.0.1', port=8080, socket_path=None):
+    """
+    Create a render server for the service on a Unix domain socket if
+    socket_path is given, otherwise on host and port.
+    """
+    handler, http_server, unix_server = server_classes()
+    if socket_path:
+        server = unix_server(socket_path, handler)
+    else:
+        server = http_server((host, port), handler)
+    server.service = service
+    return server
+
+
+def make_bench_image(path, shade):
+    """
+    Write a synthetic JPEG image.
+    """
+    from PIL import Image
+    image = Image.new('RGB', (320, 240))
+    image.putdata([((x + shade) % 256, (y * 2) % 256, shade % 256)
+            for y in range(240) for x in range(320)])
+    image.save(path)
+
+
+def make_bench_scenario(directory, pages=1, fields=10, text=20, images=0,
+        rotation=0):
+    """
+    Write a synthetic base form with the given number of pages and form data
+    with fields text fields of about text characters and images image fields
+    on every page. Return the base form and form data file names.
+    """
+    base_form = os.path.join(directory, 'base.pdf')
+    form_data_file = os.path.join(directory, 'form_data.json')
+
+    form = canvas.Canvas(base_form)
+    width, height = form._pagesize
+    for page_num in range(1, pages + 1):
+        form.drawString(36, height - 36, "Page {}".format(page_num))
+        for y in range(72, int(height) - 72, 24):
+            form.line(36, y, width - 36, y)
+        form.showPage()
+    form.save()
+
+    image_files = []
+    for i in range(min(images, 4)):
+        image_files.append(os.path.join(directory, 'image{}.jpg'.format(i)))
+        make_bench_image(image_files[-1], i * 64)
+
+    body = BENCH_TEXT * (text // len(BENCH_TEXT) + 1)
+    form_data = []
+    for page_num in range(1, pages + 1):
+        for i in range(fields):
+            form_data.append({
+                "page": page_num,
+                "x": 36 + (i % 3) * 180,
+                "y": 72 + (i // 3) % 30 * 24,
+                "type": "text",
+                "width": 170,
+                "height": 60 if text > 40 else 12,
+                "align_horizontal": LEFT,
+                "align_vertical": CENTER,
+                "font_face": "Helvetica",
+                "font_size": 10,
+                "rotation": rotation,
+                "fit": WRAP if text > 40 else TRUNCATE,
+                "data": "{} {}".format(i, body[:text]),
+            })
+        for i in range(images):
+            form_data.append({
+                "page": page_num,
+                "x": 36 + (i % 5) * 108,
+                "y": 72 + (i // 5) % 8 * 84,
+                "type": "image",
+                "width": 100,
+                "height": 75,
+                "align_horizontal": CENTER,
+                "align_vertical": CENTER,
+                "data": image_files[i % len(image_files)],
+            })
+    with open(form_data_file, 'w') as f:
+        json.dump(form_data, f)
+    return base_form, form_data_file
+
+
+class Benchmark(object):
+    """
+    Latency and peak memory of each render stage for one base form and form
+    data. Stages are timed over a number of renders. Peak memory is traced on
+    a separate render so tracing does not skew the timings.
+    """
+
+    def __init__(self, base_form, form_data_file):
+        self.base_form = base_form
+        self.form_data_file = form_data_file
+        self.form_cache = BaseFormCache()
+        self.latencies = OrderedDict((x, []) for x in BENCH_STAGES)
+        self.peaks = OrderedDict((x, 0) for x in BENCH_STAGES)
+        self.tracing = []
+
+    def run(self, iterations=BENCH_ITERATIONS):
+        """
+        Warm the caches, time iterations renders and startups, then trace
+        one render.
+        """
+        self.render(self.call)
+        bundle_file = os.path.join(os.path.dirname(self.base_form),
+                'bundle.filler')
+        write_bundle(FormRenderer(self.base_form, None, None,
+                form_cache=self.form_cache).bundle(), bundle_file)
+        for _ in range(iterations):
+            self.render(self.time)
+            self.time('startup', self.startup, bundle_file)
+        tracemalloc.start()
+        try:
+            self.render(self.trace)
+        finally:
+            tracemalloc.stop()
+
+    def render(self, measure):
+        """
+        Render the form data once, measuring each stage with measure.
+        """
+        measure('document', self.render_stages, measure)
+
+    def render_stages(self, measure):
+        """
+        The stages of FormRenderer.render(), each measured separately.
+        """
+        renderer = measure('init', FormRenderer, self.base_form,
+                self.form_data_file, None, form_cache=self.form_cache)
+        renderer.load_base_form()
+        render_field = renderer.render_field
+        renderer.render_field = lambda field, value: measure('render_field',
+                render_field, field, value)
+        overlay, overlay_pages = measure('overlay', renderer.render_overlay,
+                renderer.plan)
+        output = measure('merge', renderer.merge_overlay, overlay,
+                overlay_pages)
+        measure('write', output.write, OutputStream(CharIO()))
+
+    def startup(self, bundle_file):
+        """
+        Start a new interpreter that gets ready to render from the bundle,
+        as the command line does.
+        """
+        subprocess.check_call([sys.executable, '-c', BENCH_STARTUP,
+                os.path.dirname(os.path.abspath(__file__)), bundle_file])
+
+    def call(self, stage, func, *args, **kwargs):
+        """
+        Call func without measuring it.
+        """
+        return func(*args, **kwargs)
+
+    def time(self, stage, func, *args, **kwargs):
+        """
+        Call func and record its latency for stage.
+        """
+        start = default_timer()
+        result = func(*args, **kwargs)
+        self.latencies[stage].append(default_timer() - start)
+        return result
+
+    def trace(self, stage, func, *args, **kwargs):
+        """
+        Call func and record the most memory allocated at once during the
+        call for stage. The peak seen so far by an enclosing stage is kept
+        before the peak is reset for this one.
+        """
+        current, peak = tracemalloc.get_traced_memory()
+        if self.tracing:
+            self.tracing[-1][1] = max(self.tracing[-1][1], peak)
+        tracemalloc.reset_peak()
+        self.tracing.append([current, current])
+        try:
+            return func(*args, **kwargs)
+        finally:
+            start, peak = self.tracing.pop()
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            self.peaks[stage] = max(self.peaks[stage], peak - start)
+
+    def summary(self):
+        """
+        Return count, throughput, latency percentiles and peak memory of each
+        stage as a dict.
+        """
+        summary = OrderedDict()
+        for stage, latencies in self.latencies.items():
+            total = sum(latencies)
+            summary[stage] = {
+                'count': len(latencies),
+                'per_sec': len(latencies) / total if total else 0.0,
+                'p50': percentile(latencies, 50),
+                'p99': percentile(latencies, 99),
+                'peak_bytes': self.peaks[stage],
+            }
+        return summary
+
+
+def run_benchmarks(scenarios=None, iterations=BENCH_ITERATIONS):
+    """
+    Benchmark each named scenario of BENCH_SCENARIOS, or all of them, on
+    synthetic forms in a temporary directory. Return a dict of scenario name
+    to Benchmark.summary().
+    """
+    results = OrderedDict()
+    for name in scenarios or BENCH_SCENARIOS:
+        directory = tempfile.mkdtemp(prefix='filler-bench-')
+        try:
+            files = make_bench_scenario(directory, **BENCH_SCENARIOS[name])
+            benchmark = Benchmark(*files)
+            benchmark.run(iterations)
+            results[name] = benchmark.summary()
+        finally:
+            shutil.rmtree(directory)
+    return results
+
+
+def bench_report(results):
+    """
+    Return a human readable table of benchmark results.
+    """
+    lines = ["{:<12} {:<13} {:>6} {:>10} {:>9} {:>9} {:>10}".format(
+            "scenario", "stage", "count", "per sec", "p50 ms", "p99 ms",
+            "peak KB")]
+    for name, stages in results.items():
+        for stage, result in stages.items():
+            lines.append("{:<12} {:<13} {:>6} {:>10.1f} {:>9.3f} {:>9.3f} "
+                    "{:>10.1f}".format(name, stage, result['count'],
+                    result['per_sec'], result['p50'] * 1000,
+                    result['p99'] * 1000, result['peak_bytes'] / 1024.0))
+    return "\n".join(lines) + "\n"
+
+
+def bench_regressions(results, baseline, tolerance=BENCH_TOLERANCE):
+    """
+    Compare document throughput with baseline results. Return a message for
+    each scenario more than tolerance, a fraction, slower than its baseline.
+    """
+    regressions = []
+    for name, stages in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]['document']['per_sec']
+        after = stages['document']['per_sec']
+        if after < before * (1 - tolerance):
+            regressions.append("{}: {:.1f} docs/sec, baseline {:.1f} "
+                    "docs/sec".format(name, after, before))
+    return regressions
+
+
 class FormArgumentParser(argparse.ArgumentParser):
     """
     Custom argparser.
@@ -347,10 +3597,219 @@ def usage_message(parser):
     sys.exit(3)
 
 
-def main():
+def check_bundle_args(parser, args):
+    """
+    A bundle already holds the base form, template and extra data.
+    """
+    if args.bundle and (args.base_form or args.template or args.extra_data
+            or args.preview):
+        parser.error("--bundle cannot be combined with --base-form, "
+                "--template, --extra-data or --preview.")
+
+
+def compile_main(argv):
+    """
+    Parse compile command-line arguments. Compile the template and extra
+    data for a base form into a bundle.
+    """
+    parser = FormArgumentParser(prog="filler compile")
+    parser.add_argument("-f", "--base-form",
+            help="The form to which the data will be applied.")
+    parser.add_argument("-t", "--template",
+            help="Field layout. Form data is then field name to value.")
+    parser.add_argument("-e", "--extra-data",
+            help="Extra data to be applied to every form.")
+    parser.add_argument("-p", "--preview", action='store_true',
+            help="Background coloring to help position fields.")
+    parser.add_argument("-o", "--output-file",
+            help="Write the bundle to this file.")
+    args = parser.parse_args(argv)
+
+    for arg in [args.base_form, args.output_file]:
+        if not arg:
+            usage_message(parser)
+
+    renderer = FormRenderer(args.base_form, None, None, args.extra_data,
+            args.preview, template_file=args.template)
+    write_bundle(renderer.bundle(), args.output_file)
+    return 0
+
+
+def batch_main(argv):
+    """
+    Parse batch command-line arguments. Render every record against one base
+    form and print a throughput summary. Return non-zero if any record failed.
+    """
+    parser = FormArgumentParser(prog="filler batch")
+    parser.add_argument("-f", "--base-form",
+            help="The form to which each record will be applied.")
+    parser.add_argument("-r", "--records",
+            help="JSON Lines file or directory of JSON files, one record "
+            "of form data each.")
+    parser.add_argument("-t", "--template",
+            help="Field layout. Records are then field name to value.")
+    parser.add_argument("-e", "--extra-data",
+            help="Extra data to be applied to every record.")
+    parser.add_argument("--bundle",
+            help="Base form, template and extra data as compiled by "
+            "filler compile.")
+    parser.add_argument("-o", "--output-dir",
+            help="Write completed forms to this directory.")
+    parser.add_argument("-c", "--combined",
+            help="Write all completed forms to this one PDF instead.")
+    parser.add_argument("--output-pattern", default=OUTPUT_PATTERN,
+            help="Output file name. May use {index} and {name}.")
+    parser.add_argument("-p", "--preview", action='store_true',
+            help="Background coloring to help position fields.")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+            help="Number of worker processes.")
+    parser.add_argument("--chunk-size", type=int, default=1,
+            help="Records handed to a worker at a time.")
+    parser.add_argument("--result-cache",
+            help="Reuse filled forms cached in this directory.")
+    parser.add_argument("--acroform", action='store_true',
+            help="Fill the base form's own form fields by name. Other "
+            "fields are drawn as usual.")
+    parser.add_argument("--flatten", action='store_true',
+            help="Fill form fields as with --acroform and flatten them "
+            "into the page.")
+    parser.add_argument("--incremental", action='store_true',
+            help="Append the fields to an unchanged copy of the base form "
+            "instead of rewriting it.")
+    parser.add_argument("--direct", action='store_true',
+            help="Write text, line and outline fields straight into the "
+            "page content. Forms with images are drawn as usual.")
+    args = parser.parse_args(argv)
+
+    for arg in [args.base_form or args.bundle, args.records,
+            args.output_dir or args.combined]:
+        if not arg:
+            usage_message(parser)
+    check_bundle_args(parser, args)
+
+    result_cache = None
+    if args.result_cache:
+        result_cache = ResultCache(args.result_cache)
+    renderer = FormRenderer(args.base_form, None, None, args.extra_data,
+            args.preview, template_file=args.template,
+            result_cache=result_cache, acroform=args.acroform,
+            flatten=args.flatten, incremental=args.incremental,
+            direct=args.direct, bundle_file=args.bundle)
+    if args.combined:
+        stats = renderer.render_combined(iter_records(args.records),
+                args.combined, args.workers, args.chunk_size)
+    else:
+        if not os.path.isdir(args.output_dir):
+            os.makedirs(args.output_dir)
+        stats = renderer.render_batch(iter_records(args.records),
+                args.output_dir, args.output_pattern, args.workers,
+                args.chunk_size)
+    for name, error in stats.failures:
+        sys.stderr.write("error: {}: {}\n".format(name, error))
+    sys.stdout.write(stats.report())
+    return 1 if stats.failures else 0
+
+
+def serve_main(argv):
+    """
+    Parse serve command-line arguments. Serve render requests until
+    interrupted.
+    """
+    parser = FormArgumentParser(prog="filler serve")
+    parser.add_argument("-T", "--templates",
+            help="JSON file of template id to base form, template and "
+            "extra data.")
+    parser.add_argument("--host", default='127.0.0.1',
+            help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=8080,
+            help="Port to listen on.")
+    parser.add_argument("-s", "--socket",
+            help="Listen on this Unix domain socket instead of a port.")
+    parser.add_argument("-w", "--workers", type=int,
+            help="Number of worker processes. Defaults to the CPU count.")
+    parser.add_argument("-q", "--quiet", action='store_true',
+            help="Do not log requests.")
+    parser.add_argument("--result-cache",
+            help="Serve repeated requests from filled forms cached in this "
+            "directory.")
+    args = parser.parse_args(argv)
+
+    if not args.templates:
+        usage_message(parser)
+
+    try:
+        service = RenderService(load_templates(args.templates), args.workers,
+                args.result_cache)
+    except Exception as e:
+        sys.stderr.write("error: {}\n".format(e))
+        return 1
+    server = make_server(service, args.host, args.port, args.socket)
+    server.quiet = args.quiet
+    sys.stderr.write("Serving on {}\n".format(args.socket or
+            "http://{}:{}".format(*server.server_address[:2])))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if args.socket and os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+
+def bench_main(argv):
+    """
+    Parse bench command-line arguments. Benchmark the render stages on
+    synthetic forms and print the results. Return non-zero if throughput
+    regressed against the baseline.
+    """
+    parser = FormArgumentParser(prog="filler bench")
+    parser.add_argument("-s", "--scenario", action='append',
+            choices=list(BENCH_SCENARIOS),
+            help="Scenario to run. May be repeated. Defaults to all.")
+    parser.add_argument("-n", "--iterations", type=int,
+            default=BENCH_ITERATIONS, help="Timed renders per scenario.")
+    parser.add_argument("-j", "--json",
+            help="Also write the results to this JSON file.")
+    parser.add_argument("-b", "--baseline",
+            help="JSON results of an earlier run to compare against.")
+    parser.add_argument("--tolerance", type=float, default=BENCH_TOLERANCE,
+            help="Allowed fraction of lost throughput against the baseline.")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.scenario, args.iterations)
+    sys.stdout.write(bench_report(results))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = bench_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            sys.stderr.write("regression: {}\n".format(regression))
+        return 1 if regressions else 0
+    return 0
+
+
+COMMANDS = {
+    'batch': batch_main,
+    'bench': bench_main,
+    'compile': compile_main,
+    'serve': serve_main,
+}
+
+
+def main(argv=None):
     """
     Parse command-line arguments. Process form.
     """
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+
     parser = FormArgumentParser()
     parser.add_argument("-f", "--base-form",
             help="The form to which the data will be applied.")
@@ -358,21 +3817,72 @@ def main():
             help="Data to be applied to the form.")
     parser.add_argument("-e", "--extra-data",
             help="Extra data to be applied to the form.")
+    parser.add_argument("-t", "--template",
+            help="Field layout. Form data is then field name to value.")
+    parser.add_argument("--bundle",
+            help="Base form, template and extra data as compiled by "
+            "filler compile.")
     parser.add_argument("-o", "--output-file",
-            help="Write completed form to this file.")
+            help="Write completed form to this file. Use - for stdout.")
     parser.add_argument("-p", "--preview", action='store_true',
             help="Background coloring to help position fields.")
-    args = parser.parse_args()
+    parser.add_argument("--result-cache",
+            help="Reuse filled forms cached in this directory.")
+    parser.add_argument("--acroform", action='store_true',
+            help="Fill the base form's own form fields by name. Other "
+            "fields are drawn as usual.")
+    parser.add_argument("--flatten", action='store_true',
+            help="Fill form fields as with --acroform and flatten them "
+            "into the page.")
+    parser.add_argument("--incremental", action='store_true',
+            help="Append the fields to an unchanged copy of the base form "
+            "instead of rewriting it.")
+    parser.add_argument("--direct", action='store_true',
+            help="Write text, line and outline fields straight into the "
+            "page content. Forms with images are drawn as usual.")
+    parser.add_argument("--profile", nargs='?', const='stages',
+            choices=['stages', 'cprofile'],
+            help="Print time spent in each stage, or cProfile statistics, "
+            "to stderr.")
+    args = parser.parse_args(argv)
 
     # Let extra-data be optional. The remainder cannot be optional.
-    for arg in [args.base_form, args.form_data, args.output_file]:
+    for arg in [args.base_form or args.bundle, args.form_data,
+            args.output_file]:
         if not arg:
             usage_message(parser)
+    check_bundle_args(parser, args)
+
+    profile = None
+    if args.profile == 'cprofile':
+        profile = cProfile.Profile()
+        profile.enable()
 
+    result_cache = None
+    if args.result_cache:
+        result_cache = ResultCache(args.result_cache)
     renderer = FormRenderer(args.base_form, args.form_data, args.output_file,
-            args.extra_data, args.preview)
-    renderer.render()
+            args.extra_data, args.preview, template_file=args.template,
+            result_cache=result_cache, acroform=args.acroform,
+            flatten=args.flatten, incremental=args.incremental,
+            direct=args.direct, bundle_file=args.bundle)
+    # From importing this module to being ready to render.
+    renderer.metrics.time('startup', default_timer() - STARTED)
+    if args.output_file == '-':
+        renderer.render(getattr(sys.stdout, 'buffer', sys.stdout))
+    else:
+        renderer.render()
+
+    if profile:
+        profile.disable()
+        stats = pstats.Stats(profile, stream=sys.stderr)
+        stats.sort_stats('cumulative').print_stats(PROFILE_LINES)
+    elif args.profile:
+        sys.stderr.write(renderer.metrics.report())
 
 
 if __name__ == "__main__": # pragma: no cover
-    main()
+    # Run as the filler module so that bundles and worker processes refer
+    # to its classes rather than to __main__.
+    import filler
+    sys.exit(filler.main())
@@ -8,7 +8,7 @@ import os
 import sys
 from io import BytesIO
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
-from filler import FormRenderer
+from filler import FormRenderer, BaseFormCache
 
 @pytest.fixture
 def v1_form_data():
@@ -156,9 +156,8 @@ class TestFormRendererInitialization(object):
             fr = FormRenderer("base_form.pdf", "form_data.json",
                     "output_form.pdf")
             data = json.loads(v3_form_data)
-            fields = [x for x in data]
-            fields.sort(key=lambda x: x['page'], reverse=False)
-            assert fr.fields == fields
+            assert fr.form_data == data
+            assert sorted(fr.plan) == [1, 2]
 
     def test_extra_data(self, v3_form_data):
         """
@@ -169,9 +168,9 @@ class TestFormRendererInitialization(object):
             fr = FormRenderer("base_form.pdf", "form_data.json",
                     "output_form.pdf", "extra_data.json")
             data = json.loads(v3_form_data)
-            fields = [x for x in data] + [x for x in data]
-            fields.sort(key=lambda x: x['page'], reverse=False)
-            assert fr.fields == fields
+            assert fr.form_data == data
+            assert fr.extra_data == data
+            assert sorted(fr.static_plan) == [1, 2]
 
 @patch('filler.PdfFileReader')
 @patch('filler.PdfFileWriter')
@@ -195,8 +194,1616 @@ class TestFormRendererRenderMethod(object):
                     "output_form.pdf")
 
         mock_pdf_rdr.return_value = Rdr()
-        with patch('builtins.open', mock_open(read_data=b'0'), create=True):
+        with patch('builtins.open', mock_open(read_data=b'0'), create=True), \
+                patch('filler.os.stat'):
             fr.render()
 
         assert mock_render_field.call_count == 2
 
+
+
+@pytest.fixture
+def base_form():
+    """
+    Path to the single page example base form.
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+            'example', 'source.pdf')
+
+
+@pytest.fixture(scope="module")
+def multi_page_form(tmpdir_factory):
+    """
+    Path to a three page base form with compressed page content.
+    """
+    from reportlab.pdfgen import canvas
+    path = str(tmpdir_factory.mktemp("forms").join("three.pdf"))
+    c = canvas.Canvas(path, pageCompression=1)
+    for page_num in range(1, 4):
+        c.drawString(72, 72, "Page {}".format(page_num))
+        c.showPage()
+    c.save()
+    return path
+
+
+def text_record(value):
+    """
+    A single text field record with the given value.
+    """
+    return [{
+        "page": 1,
+        "x": 137,
+        "y": 111,
+        "type": "text",
+        "width": 400,
+        "height": 50,
+        "align_horizontal": "left",
+        "font_face": "Courier",
+        "font_size": 12,
+        "data": value,
+    }]
+
+
+class TestFormRendererBatch(object):
+    """
+    Test batch rendering against one parsed base form.
+    """
+
+    def test_render_batch(self, base_form, tmpdir):
+        """
+        One output per record. The base form is parsed only once.
+        """
+        from filler import PdfFileReader
+        records = [("rec{}".format(i), text_record("Value {}".format(i)))
+                for i in range(3)]
+        fr = FormRenderer(base_form, None, None, form_cache=BaseFormCache())
+        with patch('filler.PdfFileReader', wraps=PdfFileReader) as rdr:
+            stats = fr.render_batch(iter(records), str(tmpdir))
+
+        # One base form parse plus one overlay parse per record.
+        assert rdr.call_count == 1 + len(records)
+        assert stats.summary()['documents'] == 3
+        for i in range(3):
+            path = tmpdir.join("rec{}.pdf".format(i))
+            text = PdfFileReader(str(path)).getPage(0).extractText()
+            assert "Value {}".format(i) in text
+
+    def test_render_batch_workers(self, base_form, tmpdir):
+        """
+        A process pool renders every good record and reports the bad one.
+        """
+        bad = text_record("Bad")
+        bad[0]['font_face'] = "No-Such-Font"
+        records = [("rec0", text_record("Zero")), ("rec1", bad),
+                ("rec2", text_record("Two")), ("rec3", text_record("Three"))]
+        fr = FormRenderer(base_form, None, None)
+        stats = fr.render_batch(iter(records), str(tmpdir), workers=2,
+                chunksize=2)
+
+        assert stats.summary()['documents'] == 4
+        assert [name for name, _ in stats.failures] == ["rec1"]
+        assert sorted(os.listdir(str(tmpdir))) == [
+                "rec0.pdf", "rec2.pdf", "rec3.pdf"]
+
+    def test_worker_fails_to_start(self, tmpdir):
+        """
+        Workers that cannot load the base form fail every record instead of
+        hanging the pool.
+        """
+        missing = str(tmpdir.join("missing.pdf"))
+        records = [("rec{}".format(i), text_record("Value")) for i in range(3)]
+        fr = FormRenderer(missing, None, None)
+        stats = fr.render_batch(iter(records), str(tmpdir), workers=2)
+
+        assert [name for name, _ in stats.failures] == ["rec0", "rec1", "rec2"]
+        assert "missing.pdf" in stats.failures[0][1]
+
+    def test_iter_records_jsonl(self, tmpdir):
+        """
+        JSON Lines records are named by their position.
+        """
+        from filler import iter_records
+        path = tmpdir.join("records.jsonl")
+        path.write("\n".join(json.dumps(text_record(v)) for v in "ab") + "\n")
+        records = list(iter_records(str(path)))
+        assert [name for name, _ in records] == ["000000", "000001"]
+        assert records[1][1][0]['data'] == "b"
+
+    def test_batch_main(self, base_form, tmpdir, capsys):
+        """
+        The batch subcommand renders a directory of records and reports.
+        """
+        from filler import main
+        records = tmpdir.mkdir("records")
+        records.join("first.json").write(json.dumps(text_record("First")))
+        records.join("second.json").write(json.dumps(text_record("Second")))
+        out = tmpdir.join("out")
+        main(["batch", "-f", base_form, "-r", str(records), "-o", str(out)])
+        assert sorted(os.listdir(str(out))) == ["first.pdf", "second.pdf"]
+        assert "2 documents" in capsys.readouterr().out
+
+
+class TestBaseFormCache(object):
+    """
+    Test the parsed base form cache.
+    """
+
+    def test_hit_and_miss(self, base_form):
+        """
+        The second lookup of an unchanged form is a hit on the same object.
+        """
+        cache = BaseFormCache()
+        first = cache.get(base_form)
+        assert cache.get(base_form) is first
+        assert cache.stats()['hits'] == 1
+        assert cache.stats()['misses'] == 1
+
+    def test_changed_file(self, base_form, tmpdir):
+        """
+        A form that changed on disk is parsed again.
+        """
+        path = tmpdir.join("form.pdf")
+        path.write_binary(open(base_form, 'rb').read())
+        cache = BaseFormCache()
+        first = cache.get(str(path))
+        path.setmtime(path.mtime() + 10)
+        assert cache.get(str(path)) is not first
+        assert cache.stats()['misses'] == 2
+
+    def test_eviction(self, base_form, tmpdir):
+        """
+        Least recently used forms are evicted to stay under the byte cap.
+        """
+        paths = []
+        for i in range(3):
+            path = tmpdir.join("form{}.pdf".format(i))
+            path.write_binary(open(base_form, 'rb').read())
+            paths.append(str(path))
+        size = os.path.getsize(base_form)
+        cache = BaseFormCache(max_bytes=2 * size)
+        cache.get(paths[0])
+        cache.get(paths[1])
+        cache.get(paths[0])
+        cache.get(paths[2])
+
+        stats = cache.stats()
+        assert stats['evictions'] == 1
+        assert stats['entries'] == 2
+        assert stats['bytes'] == 2 * size
+        cache.get(paths[0])
+        assert cache.stats()['hits'] == 2
+
+    @pytest.mark.parametrize("mapped", [True, False])
+    def test_mapped(self, base_form, mapped):
+        """
+        Form files are memory mapped unless told otherwise. Both read the
+        same form.
+        """
+        import hashlib
+        import mmap
+        form = BaseFormCache(mapped=mapped).get(base_form)
+        assert isinstance(form.docbuf, mmap.mmap) == mapped
+        with open(base_form, 'rb') as f:
+            data = f.read()
+        assert bytes(form.data()) == data
+        assert form.digest() == hashlib.sha256(data).hexdigest()
+        assert form.size == len(data)
+        assert form.pages == 1
+
+    def test_unmappable(self):
+        """
+        Files that cannot be mapped are read instead.
+        """
+        from filler import map_file
+        read_fd, write_fd = os.pipe()
+        os.close(write_fd)
+        with os.fdopen(read_fd, 'rb') as f:
+            assert map_file(f) is None
+
+
+class TestCompiledFields(object):
+    """
+    Test compiled field layouts.
+    """
+
+    def test_compile_shared(self, base_form):
+        """
+        Fields that differ only by value share one compiled field.
+        """
+        fr = FormRenderer(base_form, None, None)
+        fr.set_fields(text_record("One"))
+        first, value = fr.plan[1][0]
+        assert value == "One"
+        fr.set_fields(text_record("Two"))
+        second, value = fr.plan[1][0]
+        assert value == "Two"
+        assert first is second
+
+    def test_compile_resolved(self, base_form, v3_form_data):
+        """
+        Position, color, rotation and draw point are resolved up front.
+        """
+        fr = FormRenderer(base_form, None, None)
+        field = json.loads(v3_form_data)[0]
+        compiled = fr.compile_field(field)
+        assert compiled.position == (137.0, 111.0, 400.0, 50.0)
+        assert compiled.rgb == (0, 0, 1.0)
+        assert compiled.rotation == 0
+        assert compiled.draw_point == fr.calculate_text_draw_point(field)
+        assert compiled.draw == FormRenderer.render_text
+
+    def test_compile_unknown_type(self, base_form):
+        """
+        Unknown field types are rejected when compiled.
+        """
+        field = text_record("One")[0]
+        field['type'] = "circle"
+        fr = FormRenderer(base_form, None, None)
+        with pytest.raises(Exception):
+            fr.compile_field(field)
+
+    def test_typed_fields(self, base_form, image_file):
+        """
+        Each field type compiles to its own slotted class.
+        """
+        from filler import TextField, ImageField
+        fr = FormRenderer(base_form, None, None)
+        text = fr.compile_field(text_record("One")[0])
+        image = fr.compile_field(image_field(image_file, 100))
+        assert type(text) is TextField
+        assert type(image) is ImageField
+        assert not hasattr(text, '__dict__')
+        with pytest.raises(AttributeError):
+            image.font_face
+
+    @pytest.mark.parametrize("attrs, message", [
+        ({"x": None}, "is missing x"),
+        ({"page": None}, "is missing page"),
+        ({"font_size": "big"}, "is invalid"),
+        ({"font_face": "Comic"}, "is invalid: unknown font Comic"),
+        ({"align_horizontal": "middle"}, "is invalid: unknown alignment middle"),
+        ({"fit": "squeeze"}, "is invalid: unknown fit squeeze"),
+    ])
+    def test_invalid_field(self, base_form, tmpdir, attrs, message):
+        """
+        Invalid fields are reported by name when the form data is loaded.
+        """
+        field = text_record("One")[0]
+        field.update(attrs, comment="Customer")
+        field = dict((k, v) for k, v in field.items() if v is not None)
+        form_data = tmpdir.join("form_data.json")
+        form_data.write(json.dumps([field]))
+        with pytest.raises(Exception) as e:
+            FormRenderer(base_form, str(form_data), None)
+        assert "Field 'Customer' " + message in str(e.value)
+
+
+class TestTemplate(object):
+    """
+    Test template layouts bound to field name to value records.
+    """
+
+    @pytest.fixture
+    def template(self):
+        """
+        Named text field plus an unnamed field with a fixed value.
+        """
+        named = text_record("")[0]
+        named['name'] = "customer"
+        fixed = text_record("Fixed")[0]
+        fixed['y'] = 200
+        return [named, fixed]
+
+    def test_set_values(self, base_form, template):
+        """
+        Record values replace defaults by name. The layout is compiled once.
+        """
+        fr = FormRenderer(base_form, None, None)
+        fr.load_template(template)
+        fr.set_form_data({"customer": "ACME", "unused": "x"})
+        first = [field for field, _ in fr.plan[1]]
+        assert [value for _, value in fr.plan[1]] == ["ACME"]
+        fr.set_form_data({})
+        assert [value for _, value in fr.plan[1]] == [""]
+        assert [field for field, _ in fr.plan[1]] == first
+        assert [value for _, value in fr.static_plan[1]] == ["Fixed"]
+
+    def test_values_without_template(self, base_form):
+        """
+        A mapping of values needs a template.
+        """
+        fr = FormRenderer(base_form, None, None)
+        with pytest.raises(Exception):
+            fr.set_form_data({"customer": "ACME"})
+
+    def test_missing_values(self, base_form, template):
+        """
+        A null record value or a field without a value draws nothing.
+        """
+        from filler import PdfFileReader
+        fr = FormRenderer(base_form, None, None)
+        fr.load_template(template)
+        fields = text_record(None)
+        del fields[0]['data']
+        for form_data in ({"customer": None}, fields):
+            fr.set_form_data(form_data)
+            output = BytesIO()
+            fr.render(output)
+            text = PdfFileReader(output).getPage(0).extractText()
+            assert "None" not in text
+
+    def test_render_batch_template(self, base_form, template, tmpdir):
+        """
+        Batch records are field name to value mappings.
+        """
+        from filler import PdfFileReader
+        path = tmpdir.join("template.json")
+        path.write(json.dumps(template))
+        fr = FormRenderer(base_form, None, None, template_file=str(path))
+        records = [("a", {"customer": "Alpha"}), ("b", {"customer": "Beta"})]
+        stats = fr.render_batch(iter(records), str(tmpdir))
+        assert stats.failures == []
+        text = PdfFileReader(str(tmpdir.join("b.pdf"))).getPage(0).extractText()
+        assert "Beta" in text
+        assert "Fixed" in text
+
+
+class TestFitText(object):
+    """
+    Test fitting text values within the field width.
+    """
+
+    def compiled(self, base_form, width, **attrs):
+        """
+        Compiled Courier 10pt text field. Each Courier glyph is 6pt wide.
+        """
+        field = text_record("")[0]
+        field.update(width=width, font_size=10, **attrs)
+        fr = FormRenderer(base_form, None, None)
+        return fr, fr.compile_field(field)
+
+    def test_fit_prefix(self):
+        """
+        Summing glyph widths finds the same cut point as measuring every
+        prefix with reportlab.
+        """
+        from filler import FontMetrics, pdfmetrics
+        metrics = FontMetrics("Helvetica")
+        text = "The quick brown fox jumps over the lazy dog. " * 20
+        for width in (0, 3, 50, 333.3, 1000, 100000):
+            expected = max(i for i in range(len(text) + 1)
+                    if pdfmetrics.stringWidth(text[:i], "Helvetica", 11)
+                    <= width)
+            assert metrics.fit_prefix(text, width, 11) == expected
+
+    def test_string_width_cache(self):
+        """
+        String widths match reportlab and repeats are served from the LRU.
+        """
+        from filler import FontMetrics, pdfmetrics, wrap_text
+        metrics = FontMetrics("Helvetica", max_strings=2)
+        for text in ("Texas", "Ohio", "Texas"):
+            assert metrics.string_width(text, 12) == pytest.approx(
+                    pdfmetrics.stringWidth(text, "Helvetica", 12))
+        assert (metrics.hits, metrics.misses) == (1, 2)
+        metrics.string_width("Utah", 12)
+        metrics.string_width("Ohio", 12)
+        assert metrics.misses == 4
+        assert list(metrics.strings) == [("Utah", 12), ("Ohio", 12)]
+
+        metrics.max_strings = 4096
+        metrics.strings.clear()
+        text = "The quick brown fox jumps over the lazy dog. " * 100
+        lines = wrap_text(text, 200, 1000, lambda text, width:
+                metrics.fit_prefix(text, width, 12))
+        assert "".join(lines).replace(" ", "") == text.replace(" ", "")
+        assert metrics.string_width(text, 12) == pytest.approx(
+                pdfmetrics.stringWidth(text, "Helvetica", 12))
+        assert not metrics.strings
+
+    def test_truncate(self, base_form):
+        """
+        The default strategy truncates to the longest prefix that fits.
+        """
+        fr, field = self.compiled(base_form, 30)
+        assert fr.fit_text(field, "ABCDEFGH") == (["ABCDE"], 10)
+
+    def test_truncate_single_char(self, base_form):
+        """
+        A single character that fits is drawn. One that does not is an error.
+        """
+        fr, field = self.compiled(base_form, 8)
+        assert fr.fit_text(field, "AB") == (["A"], 10)
+        fr, field = self.compiled(base_form, 5)
+        with pytest.raises(Exception):
+            fr.fit_text(field, "AB")
+
+    def test_ellipsis(self, base_form):
+        """
+        Truncated text ends with an ellipsis.
+        """
+        fr, field = self.compiled(base_form, 48, fit="ellipsis")
+        assert fr.fit_text(field, "ABCDEFGHIJ") == (["ABCDE..."], 10)
+        assert fr.fit_text(field, "ABCD") == (["ABCD"], 10)
+        # Too narrow for the ellipsis.
+        fr, field = self.compiled(base_form, 15, fit="ellipsis")
+        assert fr.fit_text(field, "ABCDEFGHIJ") == (["AB"], 10)
+
+    def test_shrink(self, base_form):
+        """
+        The font shrinks to fit, but not below the minimum font size.
+        """
+        fr, field = self.compiled(base_form, 30, fit="shrink")
+        assert fr.fit_text(field, "ABCDEFGHIJ") == (["ABCDEFGHIJ"], 5)
+        fr, field = self.compiled(base_form, 30, fit="shrink",
+                min_font_size=6)
+        lines, size = fr.fit_text(field, "ABCDEFGHIJ")
+        assert (lines, size) == (["ABCDEFGH"], 6)
+
+    def test_wrap(self, base_form):
+        """
+        Text wraps at spaces onto as many lines as the field height allows.
+        """
+        fr, field = self.compiled(base_form, 60, fit="wrap", height=36)
+        lines, _ = fr.fit_text(field, "one two three four five six seven")
+        assert lines == ["one two", "three four", "five six s"]
+
+    def test_unknown_fit(self, base_form):
+        """
+        Unknown fit strategies are rejected when compiled.
+        """
+        with pytest.raises(Exception):
+            self.compiled(base_form, 30, fit="squeeze")
+
+
+@pytest.fixture
+def image_file():
+    """
+    Path to the example JPEG image.
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+            'example', 'image.jpg')
+
+
+def image_field(path, x):
+    """
+    An image field at x.
+    """
+    return {"page": 1, "x": x, "y": 500, "type": "image", "width": 100,
+            "height": 100, "data": path}
+
+
+class TestImageCache(object):
+    """
+    Test loading images once and embedding them once per document.
+    """
+
+    def test_shared_across_records(self, base_form, image_file, tmpdir):
+        """
+        The image is loaded once for all records and fields, and each output
+        embeds it once.
+        """
+        from filler import ImageCache, PdfFileReader
+        cache = ImageCache()
+        record = [image_field(image_file, 50), image_field(image_file, 300)]
+        fr = FormRenderer(base_form, None, None, image_cache=cache)
+        stats = fr.render_batch(iter([("a", record), ("b", record)]),
+                str(tmpdir))
+
+        assert stats.failures == []
+        assert cache.stats()['misses'] == 1
+        assert cache.stats()['hits'] == 3
+        page = PdfFileReader(str(tmpdir.join("b.pdf"))).getPage(0)
+        assert len(page['/Resources']['/XObject']) == 1
+        assert page.getContents().getData().count(b" Do") == 2
+
+    def test_eviction(self, image_file, tmpdir):
+        """
+        Images over the byte cap are evicted least recently used first.
+        """
+        from filler import ImageCache
+        paths = []
+        for i in range(2):
+            path = tmpdir.join("image{}.jpg".format(i))
+            path.write_binary(open(image_file, 'rb').read())
+            paths.append(str(path))
+        cache = ImageCache()
+        cache.max_bytes = cache.get(paths[0]).size
+        cache.get(paths[1])
+        assert cache.stats()['evictions'] == 1
+        assert cache.stats()['entries'] == 1
+        cache.get(paths[1])
+        assert cache.stats()['hits'] == 1
+
+        with patch('filler.IMAGE_DIGESTS_MAX', 1):
+            cache.digest(paths[0])
+            cache.digest(paths[1])
+        assert [x[0] for x in cache.digests] == [os.path.abspath(paths[1])]
+
+
+class TestStaticFields(object):
+    """
+    Test drawing static fields once onto a stamped base form.
+    """
+
+    def test_stamped_once(self, base_form, tmpdir):
+        """
+        Extra data is stamped onto the base form once for the whole batch.
+        """
+        from filler import PdfFileReader
+        extra = tmpdir.join("extra.json")
+        extra.write(json.dumps(text_record("Company")))
+        fr = FormRenderer(base_form, None, None, str(extra))
+        records = [("a", text_record("Alpha")), ("b", text_record("Beta"))]
+        with patch.object(fr, 'stamp_base_form',
+                wraps=fr.stamp_base_form) as stamp, \
+                patch.object(fr, 'render_field',
+                wraps=fr.render_field) as render_field:
+            stats = fr.render_batch(iter(records), str(tmpdir))
+
+        assert stats.failures == []
+        assert stamp.call_count == 1
+        assert render_field.call_count == 3
+        text = PdfFileReader(str(tmpdir.join("b.pdf"))).getPage(0).extractText()
+        assert "Company" in text
+        assert "Beta" in text
+        assert "Alpha" not in text
+
+    def test_shared_stamped_form(self, base_form, tmpdir):
+        """
+        Workers map the stamped form file written by the parent rather than
+        stamping the base form again.
+        """
+        import mmap
+        from filler import PdfFileReader
+        fr = FormRenderer(base_form, None, None)
+        fr.set_extra_data(text_record("Company"))
+        stamped = fr.write_stamped_form(str(tmpdir))
+        assert os.path.dirname(stamped[0]) == str(tmpdir)
+
+        worker = FormRenderer(base_form, None, None,
+                form_cache=BaseFormCache())
+        worker.set_extra_data(text_record("Company"))
+        worker.set_stamped_form(*stamped)
+        with patch.object(worker, 'stamp_base_form') as stamp:
+            worker.set_fields(text_record("Worker"))
+            worker.render(str(tmpdir.join("worker.pdf")))
+        assert stamp.call_count == 0
+        assert isinstance(worker.base.docbuf, mmap.mmap)
+        text = PdfFileReader(str(tmpdir.join("worker.pdf"))).getPage(
+                0).extractText()
+        assert "Company" in text
+        assert "Worker" in text
+
+        records = [("a", text_record("Alpha")), ("b", text_record("Beta"))]
+        out = tmpdir.mkdir("out")
+        stats = fr.render_batch(iter(records), str(out), workers=2)
+        assert stats.failures == []
+        text = PdfFileReader(str(out.join("b.pdf"))).getPage(0).extractText()
+        assert "Company" in text
+
+    def test_not_static(self, base_form):
+        """
+        Extra data marked not static is drawn with each record.
+        """
+        fr = FormRenderer(base_form, None, None)
+        dynamic = text_record("Drawn")
+        dynamic[0]['static'] = False
+        fr.set_extra_data(text_record("Stamped") + dynamic)
+        fr.set_fields(text_record("Record"))
+        assert [value for _, value in fr.static_plan[1]] == ["Stamped"]
+        assert sorted(value for _, value in fr.plan[1]) == ["Drawn", "Record"]
+
+
+class TestStreamingOutput(object):
+    """
+    Test writing the filled form straight to file-like targets.
+    """
+
+    def test_render_to_stream(self, base_form, tmpdir):
+        """
+        A stream that cannot tell() gets the same document as a file.
+        """
+        from filler import PdfFileReader
+
+        class Pipe(object):
+            def __init__(self):
+                self.chunks = []
+
+            def write(self, data):
+                self.chunks.append(data)
+
+        fr = FormRenderer(base_form, None, str(tmpdir.join("out.pdf")))
+        fr.set_fields(text_record("Streamed"))
+        pipe = Pipe()
+        fr.render(pipe)
+        data = b"".join(pipe.chunks)
+        assert not tmpdir.join("out.pdf").check()
+        page = PdfFileReader(BytesIO(data)).getPage(0)
+        assert "Streamed" in page.extractText()
+
+        fr.render()
+        assert tmpdir.join("out.pdf").size() == len(data)
+
+    def test_main_stdout(self, base_form, tmpdir, capsysbinary):
+        """
+        An output file of - writes the form to stdout.
+        """
+        from filler import main, PdfFileReader
+        data = tmpdir.join("data.json")
+        data.write(json.dumps(text_record("Piped")))
+        main(["-f", base_form, "-d", str(data), "-o", "-"])
+        out = capsysbinary.readouterr().out
+        assert "Piped" in PdfFileReader(BytesIO(out)).getPage(0).extractText()
+
+
+class TestOverlayPages(object):
+    """
+    Test that only pages with fields get an overlay.
+    """
+
+    def test_untouched_pages(self, multi_page_form, tmpdir):
+        """
+        Fields on page 2 only. Pages 1 and 3 keep their original content
+        stream.
+        """
+        from filler import PdfFileReader
+        record = text_record("Second")
+        record[0]['page'] = 2
+        output = str(tmpdir.join("out.pdf"))
+        fr = FormRenderer(multi_page_form, None, output)
+        fr.set_fields(record)
+        fr.render()
+
+        assert fr.overlay_pages == {1: 0}
+        assert fr.final.getNumPages() == 1
+        base = PdfFileReader(multi_page_form)
+        filled = PdfFileReader(output)
+        assert filled.getNumPages() == 3
+        for i in (0, 2):
+            assert (filled.getPage(i).getContents()._data ==
+                    base.getPage(i).getContents()._data)
+        assert "Second" in filled.getPage(1).extractText()
+        assert "Page 2" in filled.getPage(1).extractText()
+
+    def test_no_fields(self, multi_page_form, tmpdir):
+        """
+        Without fields there is no overlay at all.
+        """
+        from filler import PdfFileReader
+        output = str(tmpdir.join("out.pdf"))
+        fr = FormRenderer(multi_page_form, None, output)
+        fr.render()
+        assert fr.final is None
+        assert PdfFileReader(output).getNumPages() == 3
+
+
+class TestPageIndex(object):
+    """
+    Test bucketing fields by page.
+    """
+
+    def test_plan_by_page(self, multi_page_form):
+        """
+        Fields are bucketed by page in their original order.
+        """
+        fields = []
+        for page, value in ((3, "c"), (1, "a"), (3, "d"), (2, "b")):
+            field = text_record(value)[0]
+            field['page'] = page
+            fields.append(field)
+        fr = FormRenderer(multi_page_form, None, None)
+        fr.set_fields(fields)
+        assert dict((page, [value for _, value in entries])
+                for page, entries in fr.plan.items()) == {
+                1: ["a"], 2: ["b"], 3: ["c", "d"]}
+
+    def test_outside_pages(self, multi_page_form, tmpdir):
+        """
+        Fields on pages the base form does not have are reported. The rest
+        are drawn.
+        """
+        from filler import PdfFileReader, RenderWarning
+        fields = []
+        for page, value in ((0, "Zero"), (2, "Two"), (9, "Nine")):
+            field = text_record(value)[0]
+            field['page'] = page
+            fields.append(field)
+        output = str(tmpdir.join("out.pdf"))
+        fr = FormRenderer(multi_page_form, None, output)
+        fr.set_fields(fields)
+        with pytest.warns(RenderWarning, match="pages 0, 9"):
+            fr.render()
+        assert "Two" in PdfFileReader(output).getPage(1).extractText()
+
+
+@pytest.fixture(scope="module")
+def service(tmpdir_factory):
+    """
+    Render service with one named text field template.
+    """
+    from filler import RenderService, load_templates
+    tmpdir = tmpdir_factory.mktemp("serve")
+    field = text_record("")[0]
+    field['name'] = "customer"
+    tmpdir.join("template.json").write(json.dumps([field]))
+    tmpdir.join("templates.json").write(json.dumps({
+        "statement": {"base_form": os.path.join(os.path.dirname(
+                os.path.abspath(__file__)), '..', 'example', 'source.pdf'),
+            "template": "template.json"}}))
+    service = RenderService(
+            load_templates(str(tmpdir.join("templates.json"))), 2)
+    yield service
+    service.close()
+
+
+class TestRenderServer(object):
+    """
+    Test the render server on localhost.
+    """
+
+    def serve(self, server):
+        """
+        Serve in a background thread.
+        """
+        import threading
+        server.quiet = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def test_http(self, service):
+        """
+        Render over HTTP, including concurrent requests and errors.
+        """
+        from filler import make_server, PdfFileReader
+        from concurrent.futures import ThreadPoolExecutor
+        from http.client import HTTPConnection
+
+        server = make_server(service, port=0)
+        self.serve(server)
+        host, port = server.server_address[:2]
+
+        def post(path, body):
+            conn = HTTPConnection(host, port)
+            conn.request("POST", path, body)
+            response = conn.getresponse()
+            return response.status, response.read()
+
+        try:
+            with ThreadPoolExecutor(4) as executor:
+                results = list(executor.map(lambda i: post(
+                        "/render/statement",
+                        json.dumps({"customer": "Customer {}".format(i)})),
+                        range(8)))
+            for i, (status, body) in enumerate(results):
+                assert status == 200
+                text = PdfFileReader(BytesIO(body)).getPage(0).extractText()
+                assert "Customer {}".format(i) in text
+
+            assert post("/render/nothing", "{}")[0] == 404
+            assert post("/render/statement", "{")[0] == 400
+            assert post("/render/statement", "[{}]")[0] == 500
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_unix_socket(self, service, tmpdir):
+        """
+        Render over a Unix domain socket.
+        """
+        import socket
+        from filler import make_server, PdfFileReader
+        from http.client import HTTPConnection
+
+        path = str(tmpdir.join("filler.sock"))
+
+        class UnixConnection(HTTPConnection):
+            def connect(self):
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.connect(path)
+
+        server = make_server(service, socket_path=path)
+        self.serve(server)
+        try:
+            conn = UnixConnection("localhost")
+            conn.request("POST", "/render/statement",
+                    json.dumps({"customer": "Unix"}))
+            response = conn.getresponse()
+            assert response.status == 200
+            text = PdfFileReader(BytesIO(response.read())).getPage(0).extractText()
+            assert "Unix" in text
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_bad_template(self, tmpdir, capsys):
+        """
+        A template that does not load stops the server from starting, and
+        a worker that fails to load one answers its requests with the error.
+        """
+        from filler import (RenderService, serve_main, _init_service_worker,
+                _service_render)
+        templates = {"broken": {"base_form": str(tmpdir.join("none.pdf"))}}
+        with pytest.raises(Exception) as e:
+            RenderService(templates, 1)
+        assert "Template broken failed to load" in str(e.value)
+
+        path = tmpdir.join("templates.json")
+        path.write(json.dumps(templates))
+        assert serve_main(["-T", str(path)]) == 1
+        assert "broken" in capsys.readouterr().err
+
+        _init_service_worker(templates)
+        pdf, error = _service_render("broken", {})
+        assert pdf is None
+        assert "FileNotFoundError" in error
+
+
+class TestAsyncRenderer(object):
+    """
+    Test rendering from an asyncio event loop.
+    """
+
+    def test_concurrent_renders(self, base_form, tmpdir):
+        """
+        Many concurrent renders complete with at most max_in_flight running.
+        """
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        from filler import AsyncRenderer, PdfFileReader
+
+        executor = ThreadPoolExecutor(4)
+        renderer = AsyncRenderer(base_form, executor=executor,
+                max_in_flight=3)
+        peak = []
+
+        async def render(i):
+            target = str(tmpdir.join("{}.pdf".format(i)))
+            pdf = await renderer.render_async(
+                    text_record("Async {}".format(i)), target)
+            peak.append(renderer.in_flight)
+            return pdf
+
+        async def render_all():
+            return await asyncio.gather(*[render(i) for i in range(20)])
+
+        try:
+            pdfs = asyncio.run(render_all())
+        finally:
+            renderer.close()
+            executor.shutdown()
+
+        assert max(peak) <= 3
+        for i, pdf in enumerate(pdfs):
+            with open(str(tmpdir.join("{}.pdf".format(i))), 'rb') as f:
+                assert f.read() == pdf
+            text = PdfFileReader(BytesIO(pdf)).getPage(0).extractText()
+            assert "Async {}".format(i) in text
+
+    def test_slow_target(self, base_form):
+        """
+        Writing to a slow target counts against max_in_flight.
+        """
+        import asyncio
+        import threading
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+        from filler import AsyncRenderer
+
+        lock = threading.Lock()
+        writing = [0, 0]
+
+        class SlowTarget(object):
+            def write(self, pdf):
+                with lock:
+                    writing[0] += 1
+                    writing[1] = max(writing)
+                time.sleep(0.02)
+                with lock:
+                    writing[0] -= 1
+
+        executor = ThreadPoolExecutor(4)
+        renderer = AsyncRenderer(base_form, executor=executor,
+                max_in_flight=2)
+
+        async def render_all():
+            return await asyncio.gather(*[renderer.render_async(
+                    text_record("Slow"), SlowTarget()) for i in range(10)])
+
+        try:
+            asyncio.run(render_all())
+        finally:
+            renderer.close()
+            executor.shutdown()
+        assert writing[1] <= 2
+
+    def test_process_executor(self, base_form):
+        """
+        The default executor is a process pool. Errors reach the caller.
+        """
+        import asyncio
+        from filler import AsyncRenderer
+
+        renderer = AsyncRenderer(base_form, max_in_flight=2)
+
+        async def render():
+            pdf = await renderer.render_async(text_record("Pooled"))
+            with pytest.raises(Exception):
+                await renderer.render_async({"customer": "No template"})
+            return pdf
+
+        try:
+            pdf = asyncio.run(render())
+        finally:
+            renderer.close()
+        assert pdf.startswith(b"%PDF")
+
+
+class TestBenchmark(object):
+    """
+    Test the benchmark suite on a synthetic scenario.
+    """
+
+    def test_bench(self, tmpdir, capsys):
+        """
+        Every stage is reported and lost throughput against a baseline fails.
+        """
+        from filler import bench_main, BENCH_STAGES
+
+        results_file = str(tmpdir.join("bench.json"))
+        assert bench_main(["-s", "small", "-n", "2", "-j", results_file]) == 0
+        with open(results_file) as f:
+            results = json.load(f)
+        assert list(results['small']) == list(BENCH_STAGES)
+        assert results['small']['render_field']['count'] == 20
+        assert results['small']['document']['peak_bytes'] > 0
+        assert "render_field" in capsys.readouterr().out
+
+        results['small']['document']['per_sec'] *= 1000
+        with open(results_file, 'w') as f:
+            json.dump(results, f)
+        assert bench_main(["-s", "small", "-n", "2", "-b", results_file]) == 1
+        assert "regression: small" in capsys.readouterr().err
+
+
+class TestRenderMetrics(object):
+    """
+    Test per stage timings, counters and hooks.
+    """
+
+    def test_hook(self, base_form, image_file, tmpdir):
+        """
+        Hooks get the stages and counters of each render.
+        """
+        form_data = tmpdir.join("form_data.json")
+        form_data.write(json.dumps(text_record("Timed") +
+                [image_field(image_file, 100)]))
+        renderer = FormRenderer(base_form, str(form_data), None,
+                form_cache=BaseFormCache())
+        renders = []
+        renderer.metrics.add_hook(renders.append)
+
+        output = BytesIO()
+        renderer.render(output)
+        renderer.render(BytesIO())
+
+        assert len(renders) == 2
+        metrics = renders[0]
+        for stage in ('load', 'base_form', 'overlay', 'text', 'fit_text',
+                'image', 'image_load', 'merge', 'write'):
+            assert metrics['timings'][stage] >= 0
+        assert metrics['calls']['text'] == 1
+        assert metrics['calls']['image'] == 1
+        assert metrics['counters']['pages_merged'] == 1
+        assert metrics['counters']['bytes_written'] == len(output.getvalue())
+        assert metrics['counters']['bytes_read'] > os.path.getsize(base_form)
+        assert 'load' not in renders[1]['timings']
+        assert 'bytes_read' not in renders[1]['counters']
+        assert "pages_merged" in renderer.metrics.report()
+
+    def test_stamp(self, base_form):
+        """
+        Stamping static fields is timed on its own and not counted as part
+        of the render.
+        """
+        renderer = FormRenderer(base_form, None, None,
+                form_cache=BaseFormCache())
+        renderer.set_extra_data(text_record("Static"))
+        renderer.set_fields(text_record("Record"))
+        renderer.render(BytesIO())
+        metrics = renderer.metrics.last
+        assert metrics['calls']['stamp'] == 1
+        assert metrics['calls']['text'] == 1
+        assert metrics['calls']['merge'] == 1
+        assert metrics['counters']['pages'] == 1
+        assert metrics['counters']['pages_merged'] == 1
+
+
+class TestStreamingRecords(object):
+    """
+    Test reading records one at a time.
+    """
+
+    def test_json_array(self, tmpdir):
+        """
+        A JSON array is parsed element by element across small reads.
+        """
+        from filler import iter_json_array
+        values = [{"a": "x, ] [y"}, [1, 2.5, None], 12345, "tail", {}]
+        path = tmpdir.join("values.json")
+        path.write(" [ " + " ,\n".join(json.dumps(x) for x in values) + " ]\n")
+        for read_size in (1, 3, 7, 1024):
+            with open(str(path)) as f:
+                assert list(iter_json_array(f, read_size)) == values
+
+        path.write('[{"a": 1}, {"b": ')
+        with pytest.raises(ValueError):
+            with open(str(path)) as f:
+                list(iter_json_array(f, 4))
+
+    def test_json_array_records(self, tmpdir):
+        """
+        A .json records file is a JSON array of records.
+        """
+        from filler import iter_records
+        path = tmpdir.join("records.json")
+        path.write(json.dumps([text_record("a"), text_record("b")]))
+        records = list(iter_records(str(path)))
+        assert [name for name, _ in records] == ["000000", "000001"]
+        assert records[1][1][0]['data'] == "b"
+
+    def test_bounded_window(self, base_form, tmpdir):
+        """
+        Worker processes read records only as they need them.
+        """
+        from filler import BATCH_WINDOW
+        workers = 2
+
+        def records():
+            for i in range(24):
+                done = len(os.listdir(str(tmpdir)))
+                assert i - done <= workers * BATCH_WINDOW + 1
+                yield "rec{:02d}".format(i), text_record("Value {}".format(i))
+
+        fr = FormRenderer(base_form, None, None)
+        stats = fr.render_batch(records(), str(tmpdir), workers=workers)
+        assert stats.summary()['documents'] == 24
+        assert not stats.failures
+
+
+class TestCombinedOutput(object):
+    """
+    Test writing many filled forms into one PDF.
+    """
+
+    def overlay_text(self, page):
+        """
+        Content of the overlay drawn on a combined page, if any.
+        """
+        xobjects = page['/Resources'].getObject().get('/XObject', {})
+        if '/FillerOverlay' not in xobjects:
+            return b""
+        return xobjects['/FillerOverlay'].getObject().getData()
+
+    @pytest.mark.parametrize("workers", [1, 2])
+    def test_combined(self, multi_page_form, image_file, tmpdir, workers):
+        """
+        Every record adds a copy of each base form page. Base form content
+        and images are written once. Failed records are left out.
+        """
+        from filler import PdfFileReader
+        records = []
+        for i in range(6):
+            record = text_record("Record {}".format(i))
+            record[0]['page'] = 1 + i % 2 * 2
+            records.append(("rec{}".format(i), record +
+                    [image_field(image_file, 100)]))
+        records.insert(3, ("bad", [dict(text_record("Bad")[0], page="x")]))
+
+        output = str(tmpdir.join("combined.pdf"))
+        fr = FormRenderer(multi_page_form, None, None)
+        stats = fr.render_combined(iter(records), output, workers)
+
+        assert [name for name, _ in stats.failures] == ["bad"]
+        combined = PdfFileReader(output)
+        assert combined.getNumPages() == 18
+        base = PdfFileReader(multi_page_form)
+        base_contents = set()
+        images = set()
+        for i in range(18):
+            page = combined.getPage(i)
+            contents = page.raw_get('/Contents')
+            if isinstance(contents, list):
+                contents = contents[1]
+            base_contents.add(contents.idnum)
+            assert (contents.getObject().getData() ==
+                    base.getPage(i % 3).getContents().getData())
+
+            # Text is on page 1 of even records and page 3 of odd ones.
+            record, page_num = divmod(i, 3)
+            text = "Record {}".format(record).encode()
+            assert (text in self.overlay_text(page)) == \
+                    (page_num == record % 2 * 2)
+            if page_num == 0:
+                form = page['/Resources']['/XObject']['/FillerOverlay']
+                images.add(form['/Resources']['/XObject'].raw_get(
+                        '/FormXob.{}'.format(fr.image_cache.get(
+                        image_file).name)).idnum)
+        assert len(base_contents) == 3
+        assert len(images) == 1
+
+    def test_batch_combined(self, base_form, tmpdir):
+        """
+        The batch subcommand writes one combined PDF with --combined.
+        """
+        from filler import main, PdfFileReader
+        records = tmpdir.join("records.jsonl")
+        records.write("\n".join(json.dumps(text_record(x))
+                for x in ("First", "Second")))
+        output = str(tmpdir.join("all.pdf"))
+        assert main(["batch", "-f", base_form, "-r", str(records),
+                "-c", output]) == 0
+        combined = PdfFileReader(output)
+        assert combined.getNumPages() == 2
+        assert b"Second" in self.overlay_text(combined.getPage(1))
+
+
+class TestResultCache(object):
+    """
+    Test serving repeated renders from the on-disk result cache.
+    """
+
+    def test_repeat(self, base_form, image_file, tmpdir):
+        """
+        A repeated render is a hit. Changed values or image contents miss.
+        """
+        from filler import ResultCache
+        import shutil
+        image = str(tmpdir.join("image.jpg"))
+        shutil.copy(image_file, image)
+        cache = ResultCache(str(tmpdir.join("cache")))
+        fr = FormRenderer(base_form, None, None, result_cache=cache)
+
+        def render(value):
+            fr.set_fields(text_record(value) + [image_field(image, 100)])
+            output = BytesIO()
+            fr.render(output)
+            return fr.cache_hit, output.getvalue()
+
+        hit, first = render("One")
+        assert not hit
+        hit, second = render("One")
+        assert hit
+        assert second == first
+        assert not render("Two")[0]
+
+        with open(image, 'ab') as f:
+            f.write(b"\0")
+        assert not render("One")[0]
+        stats = cache.stats()
+        assert (stats['hits'], stats['misses'], stats['stores']) == (1, 3, 3)
+        assert stats['hit_rate'] == 0.25
+        assert not [x for x in tmpdir.join("cache").visit() if
+                x.basename.endswith('.tmp')]
+
+    def test_eviction(self, tmpdir):
+        """
+        Least recently used entries are removed once the cache is full.
+        """
+        from filler import ResultCache
+        cache = ResultCache(str(tmpdir), max_bytes=3500)
+        assert cache.stats()['bytes'] is None
+        for i, key in enumerate(["aa01", "bb02", "cc03"]):
+            cache.put(key, b"x" * 1000)
+            os.utime(cache.path(key), (i, i))
+        os.utime(cache.path("aa01"), (5, 5))
+        cache.put("dd04", b"x" * 1000)
+
+        assert cache.get("bb02") is None
+        for key in ("aa01", "cc03", "dd04"):
+            assert cache.get(key) == b"x" * 1000
+        assert cache.stats()['evictions'] == 1
+        assert cache.stats()['bytes'] == 3000
+        # Entries already on disk are counted from the first store, which
+        # then evicts one of them.
+        cache = ResultCache(str(tmpdir), max_bytes=3500)
+        cache.put("ee05", b"x" * 1000)
+        assert cache.stats()['evictions'] == 1
+        assert cache.stats()['bytes'] == 3000
+
+
+@pytest.fixture(scope="module")
+def acroform_form(tmpdir_factory):
+    """
+    Path to a two page base form with text, check box and radio fields.
+    """
+    from reportlab.pdfgen import canvas
+    path = str(tmpdir_factory.mktemp("forms").join("acroform.pdf"))
+    c = canvas.Canvas(path)
+    c.acroForm.textfield(name='customer', x=72, y=700, width=200, height=20)
+    c.acroForm.checkbox(name='agree', x=72, y=650, size=14)
+    for i, value in enumerate(['basic', 'pro']):
+        c.acroForm.radio(name='plan', value=value, x=72 + 30 * i, y=600)
+    c.showPage()
+    c.acroForm.textfield(name='notes', x=72, y=600, width=200, height=60,
+            fieldFlags='multiline')
+    c.showPage()
+    c.save()
+    return path
+
+
+class TestAcroForm(object):
+    """
+    Test filling the base form's own AcroForm fields.
+    """
+
+    def contents(self, page):
+        """
+        Page content streams, concatenated.
+        """
+        contents = page['/Contents'].getObject()
+        if not isinstance(contents, list):
+            contents = [contents]
+        return b"\n".join(x.getObject().getData() for x in contents)
+
+    def render(self, fr, values):
+        """
+        Render values and read the filled form back.
+        """
+        from filler import PdfFileReader
+        fr.set_form_data(values)
+        output = BytesIO()
+        fr.render(output)
+        return PdfFileReader(output)
+
+    def test_fill(self, acroform_form, tmpdir):
+        """
+        Values are set on the form's fields, with new text appearances.
+        Template fields the form does not have are drawn on the overlay.
+        """
+        from filler import NameObject
+        template = tmpdir.join("template.json")
+        template.write(json.dumps([dict(text_record("")[0], name="extra"),
+                dict(text_record("")[0], name="customer")]))
+        fr = FormRenderer(acroform_form, None, None,
+                template_file=str(template), acroform=True)
+        values = {"customer": "Ada (L)", "agree": True, "plan": "pro",
+                "notes": "Line one\nLine two", "extra": "Drawn"}
+        filled = self.render(fr, values)
+
+        fields = filled.getFields()
+        assert fields['customer']['/V'] == "Ada (L)"
+        assert fields['notes']['/V'] == "Line one\nLine two"
+        assert fields['agree']['/V'] == '/Yes'
+        assert fields['plan']['/V'] == '/pro'
+        assert filled.trailer['/Root']['/AcroForm']['/NeedAppearances']
+        page = filled.getPage(0)
+        widgets = dict((x.getObject().get('/T'), x.getObject())
+                for x in page['/Annots'])
+        appearance = widgets['customer']['/AP']['/N'].getData()
+        assert b"(Ada \\(L\\)) Tj" in appearance
+        assert [x.getObject()['/AS'] for x in fields['plan']['/Kids']] == [
+                '/Off', '/pro']
+        assert widgets['agree'].raw_get('/P').idnum == page.indirectRef.idnum
+        assert b"Drawn" in self.contents(page)
+
+        # The parsed base form is left as it was for the next render.
+        again = self.render(fr, {"customer": "Bob", "agree": False})
+        fields = again.getFields()
+        assert (fields['customer']['/V'], fields['agree']['/V']) == (
+                "Bob", '/Off')
+        assert fields['notes']['/V'] == ""
+        assert fr.form.getFields()['agree']['/V'] == NameObject('/Off')
+
+    def test_flatten(self, acroform_form):
+        """
+        Flattening draws every widget into its page and drops the form.
+        Form data fields named after a form field are filled natively.
+        """
+        fr = FormRenderer(acroform_form, None, None, flatten=True)
+        filled = self.render(fr, [dict(text_record("Flat")[0],
+                name="notes", page=2)])
+        assert '/AcroForm' not in filled.trailer['/Root']
+        page = filled.getPage(1)
+        assert '/Annots' not in page
+        xobjects = page['/Resources']['/XObject']
+        assert b"(Flat) Tj" in xobjects['/FillerWidget0'].getData()
+        assert b"/FillerWidget0 Do" in self.contents(page)
+        assert len(filled.getPage(0)['/Resources']['/XObject']) == 4
+
+
+class TestIncrementalOutput(object):
+    """
+    Test appending overlays to the base form as an incremental update.
+    """
+
+    def test_incremental(self, multi_page_form, tmpdir):
+        """
+        The base form is written as it is. Only pages with fields change.
+        """
+        from filler import PdfFileReader
+        output = str(tmpdir.join("incremental.pdf"))
+        record = text_record("Appended")
+        record[0]['page'] = 2
+        fr = FormRenderer(multi_page_form, None, output, incremental=True)
+        fr.set_fields(record)
+        fr.render()
+
+        with open(multi_page_form, 'rb') as f:
+            base = f.read()
+        with open(output, 'rb') as f:
+            filled = f.read()
+        assert filled.startswith(base)
+        assert filled.count(b"%%EOF") == base.count(b"%%EOF") + 1
+
+        original = PdfFileReader(multi_page_form)
+        filled = PdfFileReader(output)
+        assert filled.getNumPages() == 3
+        for i in (0, 2):
+            assert (filled.getPage(i).raw_get('/Contents').idnum ==
+                    original.getPage(i).raw_get('/Contents').idnum)
+        page = filled.getPage(1)
+        overlay = page['/Resources']['/XObject']['/FillerOverlay']
+        assert b"Appended" in overlay.getData()
+        assert (page['/Contents'][1].getObject().getData() ==
+                original.getPage(1).getContents().getData())
+
+    def test_extra_data(self, base_form, tmpdir):
+        """
+        Static extra data is drawn with the fields instead of being stamped
+        on the base form, which is kept as it is.
+        """
+        from filler import PdfFileReader
+        output = str(tmpdir.join("incremental.pdf"))
+        fr = FormRenderer(base_form, None, output, incremental=True)
+        fr.set_extra_data(text_record("Static"))
+        fr.set_fields(text_record("Record"))
+        fr.render()
+
+        with open(base_form, 'rb') as f:
+            base = f.read()
+        with open(output, 'rb') as f:
+            filled = f.read()
+        assert filled.startswith(base)
+        page = PdfFileReader(output).getPage(0)
+        overlay = page['/Resources']['/XObject']['/FillerOverlay'].getData()
+        assert b"Static" in overlay
+        assert b"Record" in overlay
+
+    def test_stacked(self, base_form, tmpdir):
+        """
+        Updates can be appended to forms that were updated before, with a
+        cross-reference table or stream.
+        """
+        from filler import IncrementalWriter, PdfFileReader
+        with open(base_form, 'rb') as f:
+            data = f.read()
+        reader = PdfFileReader(BytesIO(data))
+        output = BytesIO()
+        writer = IncrementalWriter(output, reader, data)
+        writer.xref_stream = True
+        writer.close()
+        path = str(tmpdir.join("stream.pdf"))
+        with open(path, 'wb') as f:
+            f.write(output.getvalue())
+
+        for i, value in enumerate(["First", "Second"]):
+            output = str(tmpdir.join("stacked{}.pdf".format(i)))
+            fr = FormRenderer(path, None, output, incremental=True)
+            fr.set_fields(text_record(value))
+            fr.render()
+            path = output
+
+        page = PdfFileReader(path).getPage(0)
+        xobjects = page['/Resources']['/XObject']
+        assert b"Second" in xobjects['/FillerOverlay'].getData()
+        assert len(page['/Contents']) == 5
+
+
+class TestDirectContent(object):
+    """
+    Test drawing fields straight into the page content.
+    """
+
+    def marks(self, pdf, page_num):
+        """
+        What a page draws: each text run and painted path, in page space,
+        with its color.
+        """
+        from filler import PdfFileReader
+        from PyPDF2.pdf import ContentStream
+        page = PdfFileReader(BytesIO(pdf)).getPage(page_num)
+        state = [1, 0, 0, 1, 0, 0], None, None
+        stack, path, marks = [], [], []
+
+        def point(x, y):
+            a, b, c, d, e, f = state[0]
+            return (round(a * x + c * y + e, 1), round(b * x + d * y + f, 1))
+
+        for operands, op in ContentStream(page.getContents(),
+                page.pdf).operations:
+            values = [float(x) for x in operands
+                    if isinstance(x, (int, float)) or hasattr(x, 'as_numeric')
+                    or type(x).__name__ in ('FloatObject', 'NumberObject')]
+            ctm, fill, stroke = state
+            if op == b'q':
+                stack.append(state)
+            elif op == b'Q':
+                state = stack.pop()
+            elif op == b'cm':
+                a, b, c, d, e, f = values
+                state = ([a * ctm[0] + b * ctm[2], a * ctm[1] + b * ctm[3],
+                        c * ctm[0] + d * ctm[2], c * ctm[1] + d * ctm[3],
+                        e * ctm[0] + f * ctm[2] + ctm[4],
+                        e * ctm[1] + f * ctm[3] + ctm[5]], fill, stroke)
+            elif op in (b'rg', b'RG'):
+                color = tuple(round(x, 3) for x in values)
+                state = (ctm, color, stroke) if op == b'rg' else \
+                        (ctm, fill, color)
+            elif op == b'Tm':
+                path = [point(*values[4:])]
+            elif op == b'Tj':
+                marks.append((operands[0], path[0], fill))
+            elif op == b're':
+                x, y, width, height = values
+                path = [point(x, y), point(x + width, y + height)]
+            elif op in (b'm', b'l', b'c'):
+                path.extend(point(*values[i:i + 2])
+                        for i in range(0, len(values), 2))
+            elif op in (b'S', b'B*'):
+                marks.append((op, path, fill, stroke))
+                path = []
+        return marks
+
+    def render(self, form, fields, **options):
+        """
+        Render fields and return the filled PDF.
+        """
+        fr = FormRenderer(form, None, None, **options)
+        fr.set_fields(fields)
+        output = BytesIO()
+        fr.render(output)
+        return fr, output.getvalue()
+
+    @pytest.mark.parametrize("preview", [None, True])
+    def test_equivalent(self, multi_page_form, preview):
+        """
+        Text, line and outline fields look the same drawn either way.
+        """
+        fields = [dict(text_record("Left (text) é→")[0]),
+                dict(text_record("Right")[0], align_horizontal="right",
+                font_face="Times-Bold", rotation=90, font_color="FF0000"),
+                dict(text_record("Centered and shrunk " * 3)[0],
+                align_horizontal="center", fit="shrink"),
+                dict(text_record("Wrapped " * 20)[0], fit="wrap", page=3),
+                dict(text_record("")[0], type="line", line_width=2),
+                dict(text_record("")[0], type="outline", rotation=45)]
+        fr, canvas = self.render(multi_page_form, fields, preview=preview)
+        assert fr.final is not None
+        fr, direct = self.render(multi_page_form, fields, preview=preview,
+                direct=True)
+        assert fr.final is None
+
+        for page_num in range(3):
+            assert (self.marks(direct, page_num) ==
+                    self.marks(canvas, page_num))
+        from filler import PdfFileReader
+        fonts = PdfFileReader(BytesIO(direct)).getPage(0)['/Resources'][
+                '/Font']
+        assert sorted(fonts[x]['/BaseFont'] for x in fonts
+                if x.startswith('/FillerFont')) == [
+                '/Courier', '/Symbol', '/Times-Bold']
+
+    def test_images_fall_back(self, base_form, image_file):
+        """
+        Forms with images are drawn with reportlab.
+        """
+        fr, _ = self.render(base_form, text_record("Text") +
+                [image_field(image_file, 100)], direct=True)
+        assert fr.final is not None
+        fr, _ = self.render(base_form, text_record("Text") +
+                [image_field("", 100)], direct=True)
+        assert fr.final is None
+
+
+class TestBundle(object):
+    """
+    Test compiled template bundles and deferred imports.
+    """
+
+    @pytest.fixture
+    def bundle(self, base_form, tmpdir):
+        """
+        A bundle of a copy of the base form with a named and a fixed field.
+        Return the base form copy and the bundle paths.
+        """
+        from filler import main
+        form = tmpdir.join("form.pdf")
+        with open(base_form, 'rb') as f:
+            form.write_binary(f.read())
+        named = text_record("")[0]
+        named['name'] = "customer"
+        fixed = text_record("Fixed")[0]
+        fixed['y'] = 200
+        template = tmpdir.join("template.json")
+        template.write(json.dumps([named, fixed]))
+        path = str(tmpdir.join("form.bundle"))
+        assert main(["compile", "-f", str(form), "-t", str(template),
+                "-o", path]) == 0
+        return form, path
+
+    def render(self, fr, values):
+        """
+        Render values and return the text of the first page.
+        """
+        from filler import PdfFileReader
+        fr.set_form_data(values)
+        output = BytesIO()
+        fr.render(output)
+        return PdfFileReader(BytesIO(output.getvalue())).getPage(
+                0).extractText()
+
+    def test_render(self, bundle):
+        """
+        A bundle renders without compiling or stamping anything again,
+        until the base form changes.
+        """
+        form, path = bundle
+        fr = FormRenderer(None, None, None, bundle_file=path)
+        assert fr.template is not None
+        with patch.object(fr, 'compile_field') as compile_field, \
+                patch.object(fr, 'stamp_base_form') as stamp_base_form:
+            text = self.render(fr, {"customer": "ACME"})
+        assert not compile_field.called
+        assert not stamp_base_form.called
+        assert "ACME" in text
+        assert "Fixed" in text
+
+        st = form.stat()
+        os.utime(str(form), (st.atime, st.mtime + 10))
+        with patch.object(fr, 'stamp_base_form',
+                wraps=fr.stamp_base_form) as stamp_base_form:
+            assert "Fixed" in self.render(fr, {"customer": "ACME"})
+        assert stamp_base_form.call_count == 1
+
+    def test_version(self, bundle, tmpdir):
+        """
+        Bundles of another version, or other files, are refused.
+        """
+        import pickle
+        from filler import BUNDLE_MAGIC, BUNDLE_VERSION
+        _, path = bundle
+        with open(path, 'rb') as f:
+            f.seek(len(pickle.dumps((BUNDLE_MAGIC, BUNDLE_VERSION), 2)))
+            body = f.read()
+        old = tmpdir.join("old.bundle")
+        old.write_binary(pickle.dumps((BUNDLE_MAGIC, BUNDLE_VERSION - 1), 2)
+                + body)
+        for path in (str(old), str(tmpdir.join("template.json"))):
+            with pytest.raises(Exception) as e:
+                FormRenderer(None, None, None, bundle_file=path)
+            assert "Compile it again" in str(e.value)
+
+    def test_lazy_imports(self, bundle):
+        """
+        Neither importing filler nor loading a bundle without images imports
+        PyPDF2, reportlab or the HTTP server.
+        """
+        import subprocess
+        _, path = bundle
+        script = ("import sys; sys.path.insert(0, sys.argv[1]); "
+                "import filler; filler.FormRenderer(None, None, None, "
+                "bundle_file=sys.argv[2]); "
+                "print(sorted(set(sys.modules) & set(['PyPDF2', "
+                "'reportlab', 'asyncio', 'http.server', 'socketserver'])))")
+        output = subprocess.check_output([sys.executable, '-c', script,
+                os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                '..'), path])
+        assert output.strip() == b"[]"
+
+        from filler import LazyImport
+        from PyPDF2.generic import NameObject
+        lazy = LazyImport('PyPDF2.generic', 'NameObject')
+        assert isinstance(NameObject('/A'), lazy)
+        assert lazy('/B') == NameObject('/B')